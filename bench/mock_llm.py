@@ -0,0 +1,135 @@
+# mock_llm.py
+# A local stand-in for an OpenAI-compatible completion endpoint, for benchmarks and offline development.
+# Point the server at it with PROWL_VLLM_ENDPOINT=http://127.0.0.1:8977
+#
+#   python bench/mock_llm.py --ttft 0.3 --tps 40 --error-rate 0.01
+
+import time
+import json
+import random
+import asyncio
+import argparse
+from collections import Counter
+
+from aiohttp import web
+
+WORDS = (
+    "the idea rests on a simple observation that every step of reasoning can be checked against what came before "
+    "so we first restate the question then list what is known and finally weigh each option in turn"
+).split()
+# prompts ending like this expect a number: after.prowl picks a thought, router.prowl picks an agent
+NUMERIC_CUES = ("Most Important Thought:", "Chosen Agent:")
+TICK = 0.01 # seconds between stream writes, tokens due in the meantime go out together
+
+class MockLLM:
+    def __init__(self, ttft:float, tps:float, tokens:int, error_rate:float, stream_error_rate:float, models:list[str], seed:int=None):
+        self.ttft = ttft
+        self.tps = tps
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.stream_error_rate = stream_error_rate
+        self.models = models
+        self.random = random.Random(seed)
+        self.stats = Counter()
+
+    def completion(self, prompt:str, max_tokens) -> list[str]:
+        """ The tokens of one answer, each a word with its leading space """
+        if prompt.rstrip().endswith(NUMERIC_CUES):
+            return [" 1"]
+        count = min(self.tokens, max_tokens or self.tokens)
+        start = self.random.randrange(len(WORDS))
+        return [" " + WORDS[(start + i) % len(WORDS)] for i in range(max(1, count))]
+
+    def chunk(self, body:dict, chat:bool, text:str, finish:str=None) -> dict:
+        if chat:
+            choice = {'index': 0, 'delta': {'content': text}, 'finish_reason': finish}
+        else:
+            choice = {'index': 0, 'text': text, 'logprobs': None, 'finish_reason': finish}
+        return {
+            'id': f"cmpl-{self.stats['requests']}", 'object': 'chat.completion.chunk' if chat else 'text_completion',
+            'created': int(time.time()), 'model': body.get('model') or self.models[0], 'choices': [choice],
+        }
+
+    async def complete(self, request:web.Request) -> web.StreamResponse:
+        chat = request.path.endswith('/chat/completions')
+        body = await request.json()
+        self.stats['requests'] += 1
+        if self.random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            return web.json_response({'error': {'message': 'mock failure', 'type': 'server_error'}}, status=500)
+        if chat:
+            prompt = "\n".join(str(m.get('content') or '') for m in body.get('messages') or [])
+        else:
+            prompt = body.get('prompt') or ''
+            prompt = prompt[0] if isinstance(prompt, list) else prompt
+        tokens = self.completion(prompt, body.get('max_tokens'))
+        self.stats['tokens'] += len(tokens)
+        await asyncio.sleep(self.ttft)
+        if not body.get('stream'):
+            await asyncio.sleep(len(tokens) / self.tps)
+            text = "".join(tokens)
+            choice = {'index': 0, 'finish_reason': 'stop'}
+            choice.update({'message': {'role': 'assistant', 'content': text}} if chat else {'text': text, 'logprobs': None})
+            return web.json_response({
+                'id': f"cmpl-{self.stats['requests']}", 'object': 'chat.completion' if chat else 'text_completion',
+                'created': int(time.time()), 'model': body.get('model') or self.models[0], 'choices': [choice],
+                'usage': {'prompt_tokens': len(prompt.split()), 'completion_tokens': len(tokens), 'total_tokens': len(prompt.split()) + len(tokens)},
+            })
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        fail_at = self.random.randrange(len(tokens)) if self.random.random() < self.stream_error_rate else None
+        started = time.monotonic()
+        sent = 0
+        while sent < len(tokens):
+            due = min(len(tokens), max(sent + 1, int((time.monotonic() - started) * self.tps) + 1))
+            if fail_at is not None and due > fail_at:
+                # the connection drops halfway through an answer
+                self.stats['stream_errors'] += 1
+                request.transport.close()
+                return response
+            text = "".join(tokens[sent:due])
+            await response.write(b"data: " + json.dumps(self.chunk(body, chat, text)).encode() + b"\n\n")
+            sent = due
+            await asyncio.sleep(TICK if sent < len(tokens) else 0)
+        await response.write(b"data: " + json.dumps(self.chunk(body, chat, "", 'stop')).encode() + b"\n\n")
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def list_models(self, request:web.Request) -> web.Response:
+        """ OpenRouter style listing, which is what the web client expects from /models """
+        return web.json_response({'object': 'list', 'data': [
+            {'id': m, 'name': m, 'object': 'model', 'owned_by': 'mock', 'context_length': 32768} for m in self.models
+        ]})
+
+    async def get_stats(self, request:web.Request) -> web.Response:
+        return web.json_response(dict(self.stats))
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        for prefix in ('', '/v1'):
+            app.router.add_post(f"{prefix}/completions", self.complete)
+            app.router.add_post(f"{prefix}/chat/completions", self.complete)
+            app.router.add_get(f"{prefix}/models", self.list_models)
+        app.router.add_get('/stats', self.get_stats)
+        return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible completion server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8977)
+    parser.add_argument('--ttft', type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument('--tps', type=float, default=50.0, help="tokens per second after the first")
+    parser.add_argument('--tokens', type=int, default=32, help="tokens per answer, capped by the request's max_tokens")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with a 500")
+    parser.add_argument('--stream-error-rate', type=float, default=0.0, help="fraction of streams cut off halfway")
+    parser.add_argument('--models', default="qwen/qwen-2.5-7b-instruct,mock/mock-small", help="comma separated model ids for /models")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    mock = MockLLM(
+        ttft=args.ttft, tps=max(args.tps, 0.001), tokens=args.tokens, error_rate=args.error_rate,
+        stream_error_rate=args.stream_error_rate, models=args.models.split(','), seed=args.seed,
+    )
+    web.run_app(mock.app(), host=args.host, port=args.port, print=lambda *_: print(f"Mock LLM on http://{args.host}:{args.port}", flush=True))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+# run.py
+# End to end benchmarks: starts the mock LLM and the server (or uses running ones), drives /think, /save, /load
+# and many-client /ws channels, and reports latency percentiles, throughput and server memory.
+#
+#   python bench/run.py                                  # everything, with defaults
+#   python bench/run.py --only ws --clients 500 --channels 10
+#   python bench/run.py --json out.json --baseline last.json --tolerance 0.2
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import signal
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ('think', 'think_cached', 'save', 'load', 'ws')
+
+def percentile(values:list[float], p:float) -> float:
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def summary(name:str, latencies:list[float], elapsed:float, errors:int, unit:str='req') -> dict:
+    """ One scenario's numbers, latencies in milliseconds """
+    ms = [x * 1000 for x in latencies]
+    return {
+        'scenario': name, 'count': len(ms), 'errors': errors, 'elapsed_s': round(elapsed, 3),
+        'throughput': round(len(ms) / elapsed, 2) if elapsed > 0 else None, 'unit': f"{unit}/s",
+        'p50_ms': percentile(ms, 0.50), 'p95_ms': percentile(ms, 0.95), 'p99_ms': percentile(ms, 0.99),
+        'max_ms': max(ms) if ms else None,
+    }
+
+def rss_bytes(pid:int) -> int:
+    """ Resident memory of `pid` and its children (uvicorn workers), from /proc; None where that is unavailable """
+    try:
+        import psutil
+        proc = psutil.Process(pid)
+        return sum(p.memory_info().rss for p in [proc, *proc.children(recursive=True)])
+    except ImportError:
+        pass
+    except Exception:
+        return None
+    total = 0
+    pids = [pid]
+    try:
+        while pids:
+            p = pids.pop()
+            with open(f"/proc/{p}/status") as f:
+                total += next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+            children = f"/proc/{p}/task/{p}/children"
+            if os.path.exists(children):
+                with open(children) as f:
+                    pids.extend(int(c) for c in f.read().split())
+    except (OSError, StopIteration, ValueError):
+        return None
+    return total
+
+async def run_pool(count:int, concurrency:int, job) -> tuple:
+    """ Runs `job(i)` `count` times, `concurrency` at a time; returns (latencies, errors, elapsed) """
+    latencies, errors = [], 0
+    queue = iter(range(count))
+    async def worker():
+        nonlocal errors
+        for i in queue:
+            started = time.perf_counter()
+            try:
+                await job(i)
+                latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                errors += 1
+                if errors <= 3:
+                    print(f"  error: {e!r}", file=sys.stderr)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    return latencies, errors, time.perf_counter() - started
+
+async def expect(response:aiohttp.ClientResponse) -> bytes:
+    body = await response.read()
+    if response.status >= 400:
+        raise RuntimeError(f"{response.method} {response.url.path}: {response.status} {body[:200]!r}")
+    return body
+
+def make_tree(nodes:int, body_chars:int) -> dict:
+    """ A random tree of `nodes` nodes shaped like the ones the web client saves """
+    rnd = random.Random(nodes)
+    def node(i:int) -> dict:
+        return {
+            'id': str(uuid.uuid4()), 'content': f"Node {i}", 'name': f"Node {i}", 'body': "x" * body_chars,
+            'metadata': {}, 'image_url': None, 'media': [], 'type': None, 'config': {}, 'children': [],
+        }
+    root = node(0)
+    all_nodes = [root]
+    for i in range(1, nodes):
+        n = node(i)
+        rnd.choice(all_nodes[-20:])['children'].append(n)
+        all_nodes.append(n)
+    return root
+
+async def bench_think(session, base:str, args, cached:bool=False) -> dict:
+    run_id = uuid.uuid4().hex[:8]
+    async def job(i):
+        # unique prompts miss the think cache, the cached pass asks the same thing every time
+        prompt = "What makes a good benchmark?" if cached else f"Question {run_id}-{i}: what makes a good benchmark?"
+        async with session.post(f"{base}/think", json={'prompt': prompt, 'agent': args.agent}) as r:
+            await expect(r)
+    if cached:
+        await job(0)
+    latencies, errors, elapsed = await run_pool(args.requests, args.concurrency, job)
+    return summary('think_cached' if cached else 'think', latencies, elapsed, errors)
+
+async def bench_save(session, base:str, args) -> dict:
+    tree = make_tree(args.nodes, args.body_chars)
+    async def job(i):
+        async with session.post(f"{base}/save", json={'name': f"bench-{i % 8}", 'data': tree}) as r:
+            await expect(r)
+    latencies, errors, elapsed = await run_pool(args.requests, args.concurrency, job)
+    return summary('save', latencies, elapsed, errors)
+
+async def bench_load(session, base:str, args) -> dict:
+    tree = make_tree(args.nodes, args.body_chars)
+    for i in range(8):
+        async with session.post(f"{base}/save", json={'name': f"bench-{i}", 'data': tree}) as r:
+            await expect(r)
+    async def job(i):
+        async with session.get(f"{base}/load/bench-{i % 8}") as r:
+            await expect(r)
+    latencies, errors, elapsed = await run_pool(args.requests, args.concurrency, job)
+    return summary('load', latencies, elapsed, errors)
+
+async def bench_ws(session, base:str, args) -> dict:
+    """
+    `clients` sockets spread over `channels`; every client sends `messages` broadcasts.
+    Latency is send -> receive for every delivered copy, throughput counts deliveries.
+    """
+    url = base.replace('http', 'ws', 1) + "/ws"
+    channels = [f"bench-ws-{uuid.uuid4().hex[:8]}" for _ in range(args.channels)]
+    members = {c: 0 for c in channels}
+    latencies, errors = [], 0
+    sockets = []
+    for i in range(args.clients):
+        channel = channels[i % len(channels)]
+        ws = await session.ws_connect(url, max_msg_size=0)
+        await ws.send_json({'action': 'join_channel', 'userId': f"bench-{i}", 'channel': channel})
+        members[channel] += 1
+        sockets.append((ws, channel))
+    expected = sum(args.messages * (members[c] - 1) for _, c in sockets)
+    delivered = asyncio.Event()
+    received = 0
+
+    async def reader(ws):
+        nonlocal received, errors
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                break
+            data = json.loads(msg.data)
+            if data.get('action') != 'bench':
+                continue
+            latencies.append(time.perf_counter() - data['sent'])
+            received += 1
+            if received >= expected:
+                delivered.set()
+
+    readers = [asyncio.create_task(reader(ws)) for ws, _ in sockets]
+    await asyncio.sleep(0.5) # let joins and syncs settle
+    started = time.perf_counter()
+    for m in range(args.messages):
+        for ws, channel in sockets:
+            try:
+                await ws.send_json({'action': 'bench', 'channel': channel, 'n': m, 'sent': time.perf_counter()})
+            except Exception:
+                errors += 1
+        await asyncio.sleep(args.interval)
+    try:
+        await asyncio.wait_for(delivered.wait(), timeout=args.timeout)
+    except asyncio.TimeoutError:
+        errors += expected - received
+        print(f"  ws: {received}/{expected} deliveries before the timeout", file=sys.stderr)
+    elapsed = time.perf_counter() - started
+    for ws, _ in sockets:
+        await ws.close()
+    for task in readers:
+        task.cancel()
+    return summary('ws', latencies, elapsed, errors, unit='msg')
+
+async def wait_ready(url:str, timeout:float=30.0):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url) as r:
+                    if r.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{url} did not come up within {timeout}s")
+            await asyncio.sleep(0.2)
+
+def start(cmd:list[str], env:dict=None) -> subprocess.Popen:
+    return subprocess.Popen(cmd, cwd=ROOT, env={**os.environ, **(env or {})}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+def stop(proc:subprocess.Popen):
+    if proc is None or proc.poll() is not None:
+        return
+    os.killpg(proc.pid, signal.SIGTERM)
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+
+def compare(results:list[dict], baseline_path:str, tolerance:float) -> list[str]:
+    """ Scenarios whose p95 or throughput got worse than the baseline by more than `tolerance` """
+    with open(baseline_path) as f:
+        baseline = {r['scenario']: r for r in json.load(f)['results']}
+    regressions = []
+    for r in results:
+        b = baseline.get(r['scenario'])
+        if not b:
+            continue
+        if b['p95_ms'] and r['p95_ms'] and r['p95_ms'] > b['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{r['scenario']}: p95 {b['p95_ms']:.1f}ms -> {r['p95_ms']:.1f}ms")
+        if b['throughput'] and r['throughput'] and r['throughput'] < b['throughput'] * (1 - tolerance):
+            regressions.append(f"{r['scenario']}: throughput {b['throughput']} -> {r['throughput']} {r['unit']}")
+    return regressions
+
+def report(results:list[dict], memory:dict):
+    fmt = lambda v: '-' if v is None else f"{v:.1f}"
+    print(f"\n{'scenario':<14}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'throughput':>16}")
+    for r in results:
+        print(f"{r['scenario']:<14}{r['count']:>7}{r['errors']:>8}{fmt(r['p50_ms']):>10}{fmt(r['p95_ms']):>10}"
+              f"{fmt(r['p99_ms']):>10}{fmt(r['max_ms']):>10}{(fmt(r['throughput']) + ' ' + r['unit']):>16}")
+    if memory.get('before') is not None:
+        mb = lambda b: f"{b / 1024 / 1024:.1f} MB" if b is not None else '-'
+        print(f"\nserver memory: {mb(memory['before'])} -> {mb(memory['after'])} (peak sampled {mb(memory['peak'])})")
+
+async def main(args):
+    procs, server = [], None
+    data_dir = None
+    try:
+        llm = args.llm
+        if llm is None:
+            llm = f"http://127.0.0.1:{args.llm_port}"
+            procs.append(start([sys.executable, 'bench/mock_llm.py', '--port', str(args.llm_port),
+                                '--ttft', str(args.ttft), '--tps', str(args.tps), '--tokens', str(args.tokens),
+                                '--error-rate', str(args.error_rate)]))
+            await wait_ready(f"{llm}/models")
+        base = args.target
+        if base is None:
+            base = f"http://127.0.0.1:{args.port}"
+            data_dir = tempfile.mkdtemp(prefix='bench-data-')
+            server = start([sys.executable, '-m', 'uvicorn', 'serve:app', '--port', str(args.port),
+                            '--workers', str(args.workers), '--log-level', 'warning'],
+                           env={'PROWL_VLLM_ENDPOINT': llm, 'DATA_PATH': data_dir + '/',
+                                'WS_BROKER': 'unix' if args.workers > 1 else 'memory'})
+            procs.append(server)
+            await wait_ready(f"{base}/defaults")
+
+        memory = {'before': rss_bytes(server.pid) if server else None}
+        memory['peak'] = memory['before']
+        async def sample():
+            while True:
+                await asyncio.sleep(0.25)
+                now = rss_bytes(server.pid)
+                if now is not None and (memory['peak'] is None or now > memory['peak']):
+                    memory['peak'] = now
+        sampler = asyncio.create_task(sample()) if server else None
+
+        results = []
+        connector = aiohttp.TCPConnector(limit=0)
+        timeout = aiohttp.ClientTimeout(total=args.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            for name in SCENARIOS:
+                if args.only and name not in args.only:
+                    continue
+                print(f"running {name} ...", file=sys.stderr)
+                if name == 'think':
+                    results.append(await bench_think(session, base, args))
+                elif name == 'think_cached':
+                    results.append(await bench_think(session, base, args, cached=True))
+                elif name == 'save':
+                    results.append(await bench_save(session, base, args))
+                elif name == 'load':
+                    results.append(await bench_load(session, base, args))
+                elif name == 'ws':
+                    results.append(await bench_ws(session, base, args))
+        if sampler:
+            sampler.cancel()
+            memory['after'] = rss_bytes(server.pid)
+        report(results, memory)
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'args': vars(args), 'results': results, 'memory': memory}, f, indent=2)
+        if args.baseline:
+            regressions = compare(results, args.baseline, args.tolerance)
+            for line in regressions:
+                print(f"REGRESSION {line}")
+            return 1 if regressions else 0
+        return 0
+    finally:
+        for proc in reversed(procs):
+            stop(proc)
+        if data_dir:
+            import shutil
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End to end benchmarks against a mock LLM")
+    parser.add_argument('--only', nargs='*', choices=SCENARIOS, help="scenarios to run, all by default")
+    parser.add_argument('--target', help="base url of a running server, otherwise one is started")
+    parser.add_argument('--port', type=int, default=8124, help="port of the server started for the run")
+    parser.add_argument('--workers', type=int, default=1, help="uvicorn workers of the started server")
+    parser.add_argument('--llm', help="base url of a running completion endpoint, otherwise the mock is started")
+    parser.add_argument('--llm-port', type=int, default=8977)
+    parser.add_argument('--ttft', type=float, default=0.05, help="mock: seconds before the first token")
+    parser.add_argument('--tps', type=float, default=500.0, help="mock: tokens per second")
+    parser.add_argument('--tokens', type=int, default=32, help="mock: tokens per answer")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="mock: fraction of failed completions")
+    parser.add_argument('--agent', default=None, help="agent for /think requests")
+    parser.add_argument('--requests', type=int, default=200, help="requests per http scenario")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--nodes', type=int, default=500, help="nodes in the saved and loaded trees")
+    parser.add_argument('--body-chars', type=int, default=400, help="body size of each node")
+    parser.add_argument('--clients', type=int, default=100, help="websocket clients")
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=10, help="broadcasts sent by every client")
+    parser.add_argument('--interval', type=float, default=0.05, help="seconds between broadcast rounds")
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--json', help="write the results here")
+    parser.add_argument('--baseline', help="results of an earlier --json run, exit 1 on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed regression against the baseline")
+    sys.exit(asyncio.run(main(parser.parse_args())))
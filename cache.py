@@ -0,0 +1,186 @@
+# cache.py
+# Content addressed cache for /think responses
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+from util import cancel_runs
+from scheduler import Overloaded
+
+THINK_CACHE_SIZE = int(os.getenv('THINK_CACHE_SIZE', 512)) # entries kept in memory
+THINK_CACHE_DIR = os.getenv('THINK_CACHE_DIR') # on-disk tier, disabled when not set
+THINK_CACHE_DISK_BYTES = int(os.getenv('THINK_CACHE_DISK_BYTES', 256 * 1024 * 1024))
+
+def request_key(**fields) -> str:
+    """ A sha256 over the normalized request fields, `None` and whitespace padding don't make a new key """
+    norm = {k: (v.strip() if isinstance(v, str) else v) for k, v in fields.items() if v is not None}
+    return hashlib.sha256(json.dumps(norm, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+class DiskTier:
+    """
+    One json file per key in `folder`, oldest files are evicted once the folder grows past `max_bytes`.
+    Calls come from worker threads, the index and byte count are kept under `lock`.
+    """
+    suffix = '.json'
+
+    def __init__(self, folder:str, max_bytes:int):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock() # forget and evict run inside get and put
+        os.makedirs(folder, exist_ok=True)
+        # key -> (size, mtime), rebuilt from the folder so the tier survives restarts
+        self.index:dict[str, tuple] = {}
+        self.bytes = 0
+        for e in os.scandir(folder):
+            if e.name.endswith(self.suffix):
+                st = e.stat()
+                self.index[e.name[:-len(self.suffix)]] = (st.st_size, st.st_mtime)
+                self.bytes += st.st_size
+
+    def path(self, key:str) -> str:
+        return os.path.join(self.folder, f"{key}{self.suffix}")
+
+    def get(self, key:str):
+        with self.lock:
+            if key not in self.index:
+                return None
+        try:
+            with open(self.path(key), 'r') as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            self.forget(key)
+            return None
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is not None:
+                self.index[key] = (entry[0], time.time())
+        return value
+
+    def put(self, key:str, value):
+        data = json.dumps(value).encode('utf-8')
+        tmp = f"{self.path(key)}.{threading.get_ident()}.tmp" # concurrent puts of one key don't share a temp file
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        with self.lock:
+            os.replace(tmp, self.path(key))
+            self.forget(key, unlink=False)
+            self.index[key] = (len(data), time.time())
+            self.bytes += len(data)
+            self.evict()
+
+    def forget(self, key:str, unlink:bool=True):
+        with self.lock:
+            if key in self.index:
+                size, _ = self.index.pop(key)
+                self.bytes -= size
+                if unlink:
+                    try:
+                        os.remove(self.path(key))
+                    except OSError:
+                        pass
+
+    def evict(self):
+        with self.lock:
+            if self.bytes <= self.max_bytes:
+                return
+            for key, _ in sorted(self.index.items(), key=lambda kv: kv[1][1]):
+                self.forget(key)
+                if self.bytes <= self.max_bytes:
+                    break
+
+class Flight:
+    """ A run in progress for `key` and how many requests wait on it """
+    def __init__(self, key:str, task:asyncio.Task):
+        self.key = key
+        self.task = task
+        self.waiters = 0
+
+class ThinkCache:
+    """
+    Memory LRU in front of an optional DiskTier.
+    `get_or_run` also coalesces concurrent identical requests onto one in-flight run.
+    """
+    def __init__(self, size:int=THINK_CACHE_SIZE, folder:str=THINK_CACHE_DIR, max_bytes:int=THINK_CACHE_DISK_BYTES):
+        self.size = size
+        self.memory:OrderedDict = OrderedDict()
+        self.disk = DiskTier(folder, max_bytes) if folder else None
+        self.inflight:dict[str, Flight] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, key:str, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    async def get(self, key:str):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.disk is not None:
+            value = await asyncio.to_thread(self.disk.get, key)
+            if value is not None:
+                self._remember(key, value)
+                return value
+        return None
+
+    async def put(self, key:str, value):
+        self._remember(key, value)
+        if self.disk is not None:
+            try:
+                await asyncio.to_thread(self.disk.put, key, value)
+            except (OSError, TypeError, ValueError) as e:
+                print("Think cache disk write failed:", e)
+
+    async def get_or_run(self, key:str, run, refresh:bool=False):
+        """
+        Returns the cached value for `key` or awaits `run()` to make it.
+        With `refresh` the cache is not read (nor joined in flight) but the new value replaces the old one.
+        The run goes in a task of its own that every identical request waits on, so a caller going away
+        doesn't cancel it for the others, only the last one leaving does. An Overloaded refusal belongs to
+        the caller who started the run (its user's queue), those who joined run it under their own ticket.
+        """
+        if not refresh:
+            value = await self.get(key)
+            if value is not None:
+                self.hits += 1
+                return dict(value)
+            if key in self.inflight:
+                try:
+                    value = await self._wait(self.inflight[key])
+                    self.hits += 1
+                    return dict(value)
+                except Overloaded:
+                    pass
+        self.misses += 1
+        flight = Flight(key, asyncio.create_task(self._run(key, run)))
+        if not refresh:
+            self.inflight[key] = flight
+        flight.task.add_done_callback(lambda _: self._land(flight))
+        return dict(await self._wait(flight))
+
+    async def _run(self, key:str, run):
+        value = await run()
+        await self.put(key, value)
+        return value
+
+    def _land(self, flight:Flight):
+        if self.inflight.get(flight.key) is flight:
+            del self.inflight[flight.key]
+
+    async def _wait(self, flight:Flight):
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                # nobody wants it anymore, new requests start over instead of joining a run being cancelled
+                self._land(flight)
+                await cancel_runs([flight.task])
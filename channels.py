@@ -0,0 +1,286 @@
+# channels.py
+# Server side copy of the tree behind each active /ws channel (the channel is the root node id).
+# Node messages are applied in order as an op log, compacted into snapshots, and written through to the TreeStore.
+
+import os
+import asyncio
+
+from storage import TreeStore, TreeNotFound, InvalidDelta
+
+CHANNEL_SNAPSHOT_OPS = int(os.getenv('CHANNEL_SNAPSHOT_OPS', 200)) # ops logged before they are compacted into a new snapshot
+CHANNEL_SAVE_INTERVAL = float(os.getenv('CHANNEL_SAVE_INTERVAL', 2.0)) # seconds between background write-through passes
+CHANNEL_SAVE_ATTEMPTS = int(os.getenv('CHANNEL_SAVE_ATTEMPTS', 5)) # failed write-throughs of a batch before it is dropped
+OP_ACTIONS = ('create', 'update', 'delete')
+RESERVED_FIELDS = ('id', 'children', 'parent', 'parent_id')
+
+class ChannelState:
+    """
+    The tree of one channel, kept flat: `nodes` maps id -> node fields, `children` id -> ordered child ids.
+
+    Every applied op gets the next `seq`. Joiners get `snapshot` (the tree as of `snapshot_seq`) plus
+    the ops logged after it, which is the same state the other clients reached by applying the ops live.
+    Changes made here and not yet stored wait in `upserts` and `deletes` for the next write-through,
+    for a tree that is in the store (`name`), `failures` counts the passes in a row that could not write them.
+    """
+    def __init__(self, channel:str, name:str=None, tree:dict=None):
+        self.channel = channel
+        self.name = name # tree name in the store, None for a tree that was never saved
+        self.seq = 0
+        self.nodes:dict[str, dict] = {}
+        self.parents:dict[str, str] = {}
+        self.children:dict[str, list] = {}
+        self.log:list[dict] = []
+        self.snapshot = None
+        self.snapshot_seq = 0
+        self.upserts:dict[str, dict] = {}
+        self.deletes:list[str] = []
+        self.failures = 0
+        if tree is not None:
+            self.load(tree)
+
+    @property
+    def seeded(self) -> bool:
+        return self.channel in self.nodes
+
+    def load(self, tree:dict):
+        """ Replaces the state with the nested `tree`, which becomes the snapshot """
+        self.nodes, self.parents, self.children = {}, {}, {}
+        stack = [(tree, None)]
+        while stack:
+            node, parent_id = stack.pop()
+            self.nodes[node['id']] = {k: v for k, v in node.items() if k not in ('children', 'truncated')}
+            self.parents[node['id']] = parent_id
+            kids = node.get('children') or []
+            self.children[node['id']] = [c['id'] for c in kids]
+            stack.extend((c, node['id']) for c in kids)
+        self.log = []
+        self.snapshot = None
+        self.snapshot_seq = self.seq
+        self.upserts, self.deletes = {}, []
+
+    def subtree(self, node_id:str) -> list[str]:
+        out, stack = [], [node_id]
+        while stack:
+            nid = stack.pop()
+            out.append(nid)
+            stack.extend(self.children.get(nid, ()))
+        return out
+
+    def inside(self, node_id:str, ancestor_id:str) -> bool:
+        """ Whether `node_id` is `ancestor_id` or somewhere below it """
+        seen = set()
+        while node_id is not None and node_id not in seen:
+            if node_id == ancestor_id:
+                return True
+            seen.add(node_id)
+            node_id = self.parents.get(node_id)
+        return False
+
+    def apply(self, message:dict, write:bool=True) -> int:
+        """
+        Applies one `create`, `update` or `delete` message and logs it, returns its `seq`.
+        With `write` the change is also queued for the store (off for ops another worker already stores,
+        and for trees that were never saved).
+        """
+        write = write and self.name is not None
+        action, node_id = message.get('action'), message.get('nodeId')
+        fields = {k: v for k, v in (message.get('fields') or {}).items() if k not in RESERVED_FIELDS}
+        if action == 'create':
+            parent_id = message.get('parentId')
+            if node_id in self.nodes and self.inside(parent_id, node_id):
+                # a node can't move into its own subtree, it stays where it is and only takes the fields
+                parent_id = self.parents.get(node_id)
+            old_parent = self.parents.get(node_id)
+            if node_id in self.nodes and old_parent != parent_id and node_id in self.children.get(old_parent, ()):
+                self.children[old_parent].remove(node_id)
+            self.nodes[node_id] = {'id': node_id, **fields}
+            self.parents[node_id] = parent_id
+            self.children.setdefault(node_id, [])
+            siblings = self.children.setdefault(parent_id, [])
+            if node_id not in siblings:
+                siblings.append(node_id)
+            # the store refuses a node under a parent it doesn't have, that would drop the whole batch
+            if write and (parent_id is None or parent_id in self.nodes):
+                self.upserts[node_id] = {'id': node_id, 'parent_id': parent_id, **fields}
+        elif action == 'update' and node_id in self.nodes:
+            self.nodes[node_id].update(fields)
+            if write:
+                self.upserts.setdefault(node_id, {'id': node_id}).update(fields)
+        elif action == 'delete' and node_id in self.nodes:
+            gone = self.subtree(node_id)
+            siblings = self.children.get(self.parents.get(node_id))
+            if siblings and node_id in siblings:
+                siblings.remove(node_id)
+            for nid in gone:
+                self.nodes.pop(nid, None)
+                self.parents.pop(nid, None)
+                self.children.pop(nid, None)
+                self.upserts.pop(nid, None)
+            if write:
+                self.deletes.append(node_id)
+        self.seq += 1
+        self.log.append({**message, 'seq': self.seq})
+        if len(self.log) >= CHANNEL_SNAPSHOT_OPS:
+            self.compact()
+        return self.seq
+
+    def build(self, node_id:str=None) -> dict:
+        """ The nested tree under `node_id` (the channel root by default), built iteratively """
+        root_id = node_id or self.channel
+        root = {**self.nodes[root_id], 'children': []}
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            for cid in self.children.get(node['id'], ()):
+                child = {**self.nodes[cid], 'children': []}
+                node['children'].append(child)
+                stack.append(child)
+        return root
+
+    def compact(self):
+        """
+        Folds the op log into a fresh snapshot. Without the tree to fold it into (never saved, and its root never created here)
+        the older half of the log is dropped instead, joiners of such a channel only get its recent ops.
+        """
+        if self.seeded:
+            self.snapshot = self.build()
+            self.snapshot_seq = self.seq
+            self.log = []
+        else:
+            del self.log[:len(self.log) // 2]
+
+    def sync_message(self) -> dict:
+        """ What a new joiner needs: the snapshot and the ops after it (just the log when the tree is unknown) """
+        if self.seeded and self.snapshot is None:
+            # nothing was logged since `load`, the current tree is the snapshot
+            if not self.log:
+                self.snapshot = self.build()
+                self.snapshot_seq = self.seq
+            else:
+                self.compact()
+        return {
+            'action': 'sync',
+            'channel': self.channel,
+            'tree': self.name,
+            'seq': self.snapshot_seq,
+            'snapshot': self.snapshot,
+            'ops': list(self.log),
+            'head': self.seq,
+        }
+
+    def take_delta(self):
+        """ Hands over the changes waiting to be stored and starts a new batch """
+        upserts, deletes = list(self.upserts.values()), self.deletes
+        self.upserts, self.deletes = {}, []
+        return upserts, deletes
+
+class ChannelStates:
+    """
+    ChannelState per active channel, seeded from the TreeStore by root id on first join.
+    Register `apply` as a ConnectionManager hook so ops from every worker reach the state in broadcast order,
+    and run `run()` in the background for write-through and to drop channels nobody is in anymore.
+    """
+    def __init__(self, store:TreeStore, manager, interval:float=CHANNEL_SAVE_INTERVAL):
+        self.store = store
+        self.manager = manager
+        self.interval = interval
+        self.states:dict[str, ChannelState] = {}
+        self.opening:dict[str, asyncio.Future] = {}
+
+    async def open(self, channel:str) -> ChannelState:
+        """ The state of `channel`, loading its tree from the store the first time """
+        if channel in self.states:
+            return self.states[channel]
+        if channel in self.opening:
+            return await asyncio.shield(self.opening[channel])
+        future = asyncio.get_running_loop().create_future()
+        self.opening[channel] = future
+        try:
+            name = await asyncio.to_thread(self.store.find_by_root, channel)
+            tree = None
+            if name is not None:
+                try:
+                    tree = await asyncio.to_thread(self.store.load_tree, name)
+                except TreeNotFound:
+                    name = None
+            state = self.states.setdefault(channel, ChannelState(channel, name, tree))
+            future.set_result(state)
+            return state
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self.opening[channel]
+
+    def apply(self, item:dict):
+        """ Broadcast hook: applies node ops to their channel and stamps the outgoing message with its `seq` """
+        message = item['message']
+        state = self.states.get(item['channel'])
+        if state is None or message.get('action') not in OP_ACTIONS:
+            return
+        # ops relayed from another worker are stored by that worker
+        message['seq'] = state.apply(message, write=item['sender'] is not None)
+
+    def saved(self, name:str, tree:dict):
+        """ A whole tree was saved outside of the channel, it replaces the state (and anything not yet written) """
+        state = self.states.get(tree.get('id'))
+        if state is not None:
+            state.name = name
+            state.seq += 1
+            state.load(tree)
+
+    async def reload(self, name:str):
+        """ Tree `name` changed in the store directly (e.g. /save/delta), re-reads it into its channel """
+        for state in list(self.states.values()):
+            if state.name == name:
+                await self.flush(state)
+                try:
+                    tree = await asyncio.to_thread(self.store.load_tree, name)
+                except TreeNotFound:
+                    state.name = None
+                    continue
+                state.seq += 1
+                state.load(tree)
+
+    async def flush(self, state:ChannelState):
+        if state.name is None or not (state.upserts or state.deletes):
+            return
+        upserts, deletes = state.take_delta()
+        try:
+            await asyncio.to_thread(self.store.apply_delta, state.name, upserts, deletes)
+        except TreeNotFound:
+            # the tree was deleted from the store, keep the channel in memory only
+            state.name = None
+            state.take_delta()
+        except InvalidDelta as e:
+            print(f"Write-through of channel {state.channel} refused, batch dropped:", e)
+        except Exception as e:
+            state.failures += 1
+            if state.failures >= CHANNEL_SAVE_ATTEMPTS:
+                print(f"Write-through of channel {state.channel} failed {state.failures} times, batch dropped:", e)
+                state.failures = 0
+                return
+            print(f"Write-through of channel {state.channel} failed:", e)
+            # put the batch back under anything that changed meanwhile, it goes with the next pass
+            for node in upserts:
+                state.upserts[node['id']] = {**node, **state.upserts.get(node['id'], {})}
+            state.deletes = deletes + state.deletes
+        else:
+            state.failures = 0
+
+    async def run(self):
+        """ Background task: writes channel changes through to the store and releases idle channels """
+        while True:
+            await asyncio.sleep(self.interval)
+            for channel, state in list(self.states.items()):
+                await self.flush(state)
+                if channel not in self.manager.channels and self.states.get(channel) is state:
+                    del self.states[channel]
+
+    async def close(self):
+        for state in list(self.states.values()):
+            await self.flush(state)
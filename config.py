@@ -0,0 +1,144 @@
+# config.py
+# defaults.yaml as a service: parsed and validated once, handed out as an immutable snapshot,
+# and reloaded when the file changes on disk.
+
+import os
+import copy
+import time
+import hashlib
+import threading
+from types import MappingProxyType
+
+import yaml
+
+from encoding import dumpb
+
+DEFAULTS_PATH = os.getenv('DEFAULTS_PATH', 'defaults.yaml')
+CONFIG_CHECK_INTERVAL = 1.0 # seconds between mtime checks, a connection storm costs one stat per interval
+
+# agent field -> accepted type
+AGENT_FIELDS = {
+    'description': str,
+    'model': str,
+    'model_vision': str,
+    'agent_name': str,
+    'user_name': str,
+    'node_type': str,
+    'context_tokens': int,
+    'think_mode': str,
+    'branches': int,
+    'branch_concurrency': int,
+    'branch_select': int,
+}
+THINK_MODES = ('sequential', 'branch')
+PROVIDERS = ('supabase', 'local', 'none') # app_config `auth` and `storage`
+
+class ConfigError(ValueError):
+    pass
+
+def validate(data) -> dict:
+    """ Checks the shape of a parsed defaults.yaml, raises ConfigError with every problem found """
+    errors = []
+    if not isinstance(data, dict):
+        raise ConfigError("defaults.yaml must be a mapping")
+    agents = data.get('agents')
+    if not isinstance(agents, dict) or not agents:
+        errors.append("`agents` must be a mapping with at least one agent")
+        agents = {}
+    for name, agent in agents.items():
+        if not isinstance(agent, dict):
+            errors.append(f"agents.{name} must be a mapping")
+            continue
+        if not agent.get('model'):
+            errors.append(f"agents.{name}.model is required")
+        for field, kind in AGENT_FIELDS.items():
+            value = agent.get(field)
+            if value is not None and (not isinstance(value, kind) or isinstance(value, bool)):
+                errors.append(f"agents.{name}.{field} must be a {kind.__name__}")
+        for field in ('context_tokens', 'branches', 'branch_concurrency', 'branch_select'):
+            if isinstance(agent.get(field), int) and agent[field] <= 0:
+                errors.append(f"agents.{name}.{field} must be positive")
+        if agent.get('think_mode') is not None and agent['think_mode'] not in THINK_MODES:
+            errors.append(f"agents.{name}.think_mode must be one of {', '.join(THINK_MODES)}")
+    app_config = data.get('app_config')
+    if not isinstance(app_config, dict):
+        errors.append("`app_config` must be a mapping")
+    else:
+        for field in ('auth', 'storage'):
+            if field in app_config and app_config[field] not in PROVIDERS:
+                errors.append(f"app_config.{field} must be one of {', '.join(PROVIDERS)}")
+    if errors:
+        raise ConfigError("; ".join(errors))
+    return data
+
+def freeze(value):
+    """ Read only view of parsed yaml: mappings become MappingProxyType, lists become tuples """
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+class Config:
+    """ One parsed version of the file: `data` is frozen, `json` is the encoded body for /defaults """
+    __slots__ = ('data', 'raw', 'json', 'etag', 'mtime')
+
+    def __init__(self, raw:dict, source:bytes, mtime:int):
+        self.raw = raw
+        self.data = freeze(raw)
+        self.json = dumpb(raw)
+        self.etag = '"' + hashlib.sha256(source).hexdigest()[:32] + '"'
+        self.mtime = mtime
+
+    def plain(self, section:str) -> dict:
+        """ A mutable copy of one section, for sending or for callers that need a real dict """
+        return copy.deepcopy(self.raw.get(section))
+
+class ConfigService:
+    """
+    Serves the latest valid snapshot of `path`.
+    A file that fails to parse or validate on reload is reported and the previous snapshot stays in use;
+    the very first load raises instead, a server without a config should not start.
+    """
+    def __init__(self, path:str=DEFAULTS_PATH, interval:float=CONFIG_CHECK_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.current:Config = None
+        self.checked = 0.0
+        self.rejected = None # mtime of a version that failed, so it is reported once
+
+    def load(self) -> Config:
+        with open(self.path, 'rb') as f:
+            source = f.read()
+            mtime = os.fstat(f.fileno()).st_mtime_ns
+        try:
+            raw = yaml.safe_load(source)
+        except yaml.YAMLError as e:
+            raise ConfigError(f"{self.path}: {e}")
+        return Config(validate(raw), source, mtime)
+
+    def get(self) -> Config:
+        now = time.monotonic()
+        if self.current is not None and now - self.checked < self.interval:
+            return self.current
+        with self.lock:
+            if self.current is not None and now - self.checked < self.interval:
+                return self.current
+            self.checked = now
+            try:
+                if self.current is None:
+                    self.current = self.load()
+                else:
+                    mtime = os.stat(self.path).st_mtime_ns
+                    if mtime not in (self.current.mtime, self.rejected):
+                        self.rejected = mtime
+                        self.current = self.load()
+                        print(f"Reloaded {self.path}")
+            except (OSError, ConfigError) as e:
+                if self.current is None:
+                    raise
+                print(f"Keeping the previous {self.path}:", e)
+        return self.current
+
+config = ConfigService()
@@ -0,0 +1,151 @@
+# context.py
+# Server side version of `sophia.compileContext`: builds the /think history from the stored tree
+# so the client only has to send a node id instead of the whole history string.
+
+import os
+import re
+import json
+import zlib
+from collections import OrderedDict
+
+from storage import TreeStore
+
+CONTEXT_TOKENS = int(os.getenv('CONTEXT_TOKENS', 6000)) # default history budget when the agent has no `context_tokens`
+CHARS_PER_TOKEN = 4 # rough estimate, good enough for budgeting without a tokenizer
+FRAGMENT_CACHE_SIZE = 4096
+
+# [Label](#uuid) links, same as `extractHashLinksFromMarkdown` in sophia.js
+PATTERN_HASH_LINK = re.compile(r'\[[^\]]+\]\(#([0-9a-zA-Z\-]+)\)')
+
+def estimate_tokens(text:str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def truncate_tokens(text:str, tokens:int) -> str:
+    """ Keeps the head of `text` within `tokens`, cutting at a line or word boundary when there is one close by """
+    limit = tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    if limit <= 0:
+        return ""
+    cut = text[:limit]
+    boundary = max(cut.rfind("\n"), cut.rfind(" "))
+    if boundary > limit * 0.8:
+        cut = cut[:boundary]
+    return cut.rstrip() + " …"
+
+class ContextBuilder:
+    """
+    Compiles ancestor history and link recall for a node from a TreeStore.
+    Formatted entries are memoized by node id and a checksum of the stored node,
+    so unchanged ancestors are neither parsed nor formatted again.
+    """
+    def __init__(self, store:TreeStore, cache_size:int=FRAGMENT_CACHE_SIZE):
+        self.store = store
+        self.cache_size = cache_size
+        self.fragments:OrderedDict = OrderedDict()
+
+    def fragment(self, node_id:str, raw:str, user_name, agent_name, show_hash:bool=False) -> tuple[str, dict]:
+        """ `sophia.formatContextEntry` for one stored node, returns the text and the links found in its body """
+        key = (node_id, zlib.crc32(raw.encode('utf-8')), len(raw), user_name, agent_name, show_hash)
+        hit = self.fragments.get(key)
+        if hit is not None:
+            self.fragments.move_to_end(key)
+            return hit
+        node = json.loads(raw)
+        metadata = node.get('metadata') if isinstance(node.get('metadata'), dict) else {}
+        name, body = node.get('name') or "", node.get('body') or ""
+        link_part = f", Link: #{node_id}" if show_hash else ""
+        if 'user_request' in metadata:
+            text = f"--- {user_name}:\n{metadata.get('user_request') or ''}\n\n--- {agent_name}: {name}{link_part}\n{body}"
+        else:
+            text = f"--- Content: {name}{link_part}\n{body}"
+        value = (text, {'name': name, 'body': body, 'links': PATTERN_HASH_LINK.findall(body)})
+        self.fragments[key] = value
+        while len(self.fragments) > self.cache_size:
+            self.fragments.popitem(last=False)
+        return value
+
+    @staticmethod
+    def config_value(configs:list[dict], key:str, default=None):
+        """ `hierarchyEditor.getConfigValue`: the nearest node config (last in `configs`) wins """
+        for config in reversed(configs):
+            if isinstance(config, dict) and key in config:
+                return config[key]
+        return default
+
+    def compile(self, tree:str, node_id:str, on_child:bool=True, max_levels:int=80, recall_depth:int=3, budget:int=CONTEXT_TOKENS, agent_config:dict=None) -> str:
+        """
+        Builds the history for a request on `node_id` of `tree`.
+
+        Args:
+            on_child: the request creates a child of `node_id` (otherwise it rewrites `node_id`).
+            max_levels: how many ancestors (including the node) may go in the history.
+            recall_depth: how many of the nearest path nodes contribute their linked nodes.
+            budget: token budget for the whole history; the oldest history goes first,
+                then linked context, and what is left of the last entry that fits gets truncated.
+            agent_config: agent settings from defaults.yaml, default `user_name` and `agent_name`.
+        """
+        agent_config = agent_config or {}
+        rows = self.store.path_to(tree, node_id)
+        configs = [json.loads(raw).get('config') for _, raw in rows]
+        user_name = self.config_value(configs, 'user_name', agent_config.get('user_name'))
+        agent_name = self.config_value(configs, 'agent_name', agent_config.get('agent_name'))
+
+        n = min(len(rows), max_levels)
+        window = rows[len(rows) - n:]
+        ids = set(r[0] for r in rows)
+        hist, links = [], OrderedDict()
+        for i, (nid, raw) in enumerate(window):
+            text, info = self.fragment(nid, raw, user_name, agent_name)
+            if on_child or i < n - 1:
+                hist.append(text)
+            if i > n - recall_depth:
+                for link in info['links']:
+                    if link not in links and link != nid and link not in ids:
+                        links[link] = None
+        if links:
+            linked = self.store.get_nodes(tree, list(links))
+            links = OrderedDict((k, self.fragment(k, linked[k], user_name, agent_name, show_hash=True)[0]) for k in links if k in linked)
+
+        # The closing block is always kept, it tells the model what to do
+        tail = []
+        last_info = self.fragment(window[-1][0], window[-1][1], user_name, agent_name)[1]
+        if not on_child and last_info['body']:
+            tail.append(f"--- Current Content: {last_info['name']}\n{last_info['body']}")
+            tail.append('## Rewrite Content Request')
+        else:
+            tail.append('## Current Request')
+        remaining = budget - estimate_tokens("\n\n".join(tail)) - 16
+        if remaining < 0 and len(tail) > 1:
+            tail[0] = truncate_tokens(tail[0], max(0, budget // 2))
+            remaining = budget - estimate_tokens("\n\n".join(tail)) - 16
+
+        # History first (newest wins), linked context gets what is left
+        kept = []
+        for text in reversed(hist):
+            cost = estimate_tokens(text) + 1
+            if cost <= remaining:
+                kept.append(text)
+                remaining -= cost
+            else:
+                if remaining > 64:
+                    kept.append(truncate_tokens(text, remaining))
+                    remaining = 0
+                break
+        kept.reverse()
+        recall = []
+        for text in links.values():
+            cost = estimate_tokens(text) + 1
+            if cost > remaining:
+                break
+            recall.append(text)
+            remaining -= cost
+
+        o = []
+        if recall:
+            o.append('## Context Linked from History')
+            o.extend(recall)
+        o.append('## Conversation History')
+        o.extend(kept)
+        o.extend(tail)
+        return "\n\n".join(o) + "\n\n"
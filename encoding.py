@@ -0,0 +1,74 @@
+# encoding.py
+# JSON encoding for hot paths: orjson when it is installed, the standard library otherwise
+
+import json
+import time
+from email.utils import parsedate_to_datetime
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+
+    def dumpb(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+except ImportError:
+    orjson = None
+
+    def dumpb(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def dumps(obj) -> str:
+    return dumpb(obj).decode('utf-8')
+
+class FastJSONResponse(JSONResponse):
+    """ JSONResponse rendered in one pass with `dumpb`, return it directly to skip FastAPI's jsonable_encoder """
+    def render(self, content) -> bytes:
+        return dumpb(content)
+
+class Frame:
+    """ A message going to many WebSockets, encoded to text once on first send and shared after that """
+    __slots__ = ('message', '_text', 'created')
+
+    def __init__(self, message: dict):
+        self.message = message
+        self._text = None
+        self.created = time.perf_counter() # for the send latency metric
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = dumps(self.message)
+        return self._text
+
+# HTTP content negotiation and validators for pre-encoded responses
+
+def accepts_encoding(accept_encoding:str, coding:str) -> bool:
+    """ True when an Accept-Encoding header allows `coding` (an explicit `q=0` refuses it) """
+    for part in (accept_encoding or "").lower().split(','):
+        name, _, params = part.strip().partition(';')
+        if name.strip() in (coding, '*'):
+            q = params.strip()
+            if q.startswith('q='):
+                try:
+                    return float(q[2:]) > 0
+                except ValueError:
+                    return False
+            return True
+    return False
+
+def etag_matches(if_none_match:str, *etags:str) -> bool:
+    """ Weak comparison of an If-None-Match header against `etags` (any of them matching), as conditional GETs use """
+    if not if_none_match:
+        return False
+    tags = {t.strip().removeprefix('W/') for t in if_none_match.split(',')}
+    return '*' in tags or any(etag.removeprefix('W/') in tags for etag in etags)
+
+def not_modified_since(if_modified_since:str, updated:float) -> bool:
+    """ True when an If-Modified-Since header is at or after `updated` (seconds, compared at HTTP's one second resolution) """
+    if not if_modified_since:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    return since is not None and int(updated) <= since.timestamp()
@@ -0,0 +1,120 @@
+# export.py
+# Document export for /download: pandoc runs in a small pool off the event loop,
+# and finished files are cached on disk by a hash of the markdown and the reference doc.
+
+import os
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import DiskTier
+
+EXPORT_CACHE_DIR = os.getenv('EXPORT_CACHE_DIR', 'cache/export/')
+EXPORT_CACHE_BYTES = int(os.getenv('EXPORT_CACHE_BYTES', 256 * 1024 * 1024))
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', 2)) # pandoc conversions running at once
+REFERENCE_DOC = 'doc/template.docx'
+DOCX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+def tree_markdown(root:dict) -> str:
+    """ `sophia.compileMarkdown`: every node in depth first order as a section anchored on its id """
+    parts = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        body = (node.get('body') or "").strip().replace("\r\n", "\n")
+        if not body.startswith("#"):
+            parts.append(f"## {node.get('name') or ''} {{#{node['id']}}}")
+            if body:
+                parts.append(body)
+        else:
+            lines = body.split("\n")
+            if "{#" not in lines[0]:
+                lines[0] += f" {{#{node['id']}}}"
+            parts.append("\n".join(lines))
+        stack.extend(reversed(node.get('children') or []))
+    return "\r\n\r\n".join(p.replace("\n", "\r\n") for p in parts).strip()
+
+class FileTier(DiskTier):
+    """ A DiskTier of finished documents, `get` hands out the cached file's path """
+    suffix = '.docx'
+
+    def get(self, key:str):
+        with self.lock:
+            if key not in self.index:
+                return None
+            path = self.path(key)
+            if not os.path.isfile(path):
+                self.forget(key, unlink=False)
+                return None
+            os.utime(path) # eviction order survives restarts
+            size, _ = self.index[key]
+            self.index[key] = (size, os.path.getmtime(path))
+            return path
+
+    def put(self, key:str, src:str) -> str:
+        with self.lock:
+            size = os.path.getsize(src)
+            os.replace(src, self.path(key))
+            self.forget(key, unlink=False)
+            self.index[key] = (size, os.path.getmtime(self.path(key)))
+            self.bytes += size
+            self.evict()
+            return self.path(key)
+
+class Exporter:
+    """
+    Markdown -> docx with pandoc in a bounded thread pool (pandoc itself is a subprocess, the threads only wait on it).
+    Identical exports running at the same time share one conversion.
+    """
+    def __init__(self, folder:str=EXPORT_CACHE_DIR, max_bytes:int=EXPORT_CACHE_BYTES, workers:int=EXPORT_WORKERS, reference_doc:str=REFERENCE_DOC):
+        self.files = FileTier(folder, max_bytes)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='export')
+        self.reference_doc = reference_doc
+        self.reference_hash = (None, None) # (mtime, sha256) of the reference doc
+        self.inflight:dict[str, asyncio.Future] = {}
+
+    def reference_digest(self) -> str:
+        mtime = os.path.getmtime(self.reference_doc)
+        if self.reference_hash[0] != mtime:
+            with open(self.reference_doc, 'rb') as f:
+                self.reference_hash = (mtime, hashlib.sha256(f.read()).hexdigest())
+        return self.reference_hash[1]
+
+    def key(self, markdown:str) -> str:
+        h = hashlib.sha256(self.reference_digest().encode('ascii'))
+        h.update(markdown.encode('utf-8'))
+        return h.hexdigest()
+
+    def convert(self, markdown:str, key:str) -> str:
+        """ Runs in the pool: converts into a temp file in the cache folder and moves it into place """
+        from pypandoc import convert_text
+        tmp = os.path.join(self.files.folder, f"{key}.{os.getpid()}.tmp")
+        try:
+            convert_text(markdown, 'docx', format='md', outputfile=tmp, extra_args=[f'--reference-doc={self.reference_doc}'])
+            return self.files.put(key, tmp)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    async def docx(self, markdown:str) -> str:
+        """ Path of the docx for `markdown`, converted now or taken from the cache """
+        loop = asyncio.get_running_loop()
+        key = await asyncio.to_thread(self.key, markdown)
+        path = self.files.get(key)
+        if path is not None:
+            return path
+        future = self.inflight.get(key)
+        if future is None:
+            # a conversion keeps going when its client leaves, the file is cached for the retry
+            future = loop.run_in_executor(self.pool, self.convert, markdown, key)
+            self.inflight[key] = future
+            future.add_done_callback(lambda f: self.done(key, f))
+        return await asyncio.shield(future)
+
+    def done(self, key:str, future:asyncio.Future):
+        self.inflight.pop(key, None)
+        if not future.cancelled():
+            future.exception() # retrieved, even when every waiter is gone
+
+    def close(self):
+        self.pool.shutdown(wait=False)
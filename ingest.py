@@ -0,0 +1,243 @@
+# ingest.py
+# Document ingestion for /upload: uploaded file -> line numbered text -> overlapping windows
+# -> `indexer.prowl` outlines (concurrently) -> one merged node tree.
+
+import os
+import re
+import time
+import uuid
+import shutil
+import asyncio
+import tempfile
+
+import metrics
+from scheduler import scheduler
+from util import get_stack, resolve_agent
+
+INGEST_WINDOW_LINES = int(os.getenv('INGEST_WINDOW_LINES', 400)) # lines sent to the indexer per call
+INGEST_OVERLAP_LINES = int(os.getenv('INGEST_OVERLAP_LINES', 40)) # lines shared by neighbouring windows
+INGEST_CONCURRENCY = int(os.getenv('INGEST_CONCURRENCY', 4)) # indexer calls in flight per upload
+INGEST_MAX_BYTES = int(os.getenv('INGEST_MAX_BYTES', 64 * 1024 * 1024))
+INGEST_JOBS_KEPT = 100 # finished jobs remembered for /upload/{job_id}
+CHUNK_BYTES = 1024 * 1024
+
+DOCX_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+TEXT_TYPES = ("text/markdown", "text/plain", "text/x-markdown")
+TEXT_EXTENSIONS = ('.md', '.markdown', '.txt')
+
+# `  - Title: 123` entries of an indexer outline
+PATTERN_OUTLINE = re.compile(r'^(\s*)[-*+]\s+(.+?)\s*:\s*(\d+)\s*$')
+
+class IngestError(ValueError):
+    pass
+
+def document_kind(content_type:str, filename:str) -> str:
+    """ 'docx', 'text' or None for what can't be ingested, by MIME type and then by extension """
+    ext = os.path.splitext(filename or '')[1].lower()
+    if content_type == DOCX_TYPE or ext == '.docx':
+        return 'docx'
+    if content_type in TEXT_TYPES or ext in TEXT_EXTENSIONS:
+        return 'text'
+    return None
+
+async def save_upload(file, path:str, max_bytes:int=INGEST_MAX_BYTES) -> int:
+    """ Streams an UploadFile to `path` in chunks, returns the size """
+    size = 0
+    with open(path, 'wb') as f:
+        while True:
+            chunk = await file.read(CHUNK_BYTES)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise IngestError(f"Upload is larger than {max_bytes} bytes")
+            await asyncio.to_thread(f.write, chunk)
+    return size
+
+def read_lines(path:str, kind:str) -> list[str]:
+    """ The document as a list of text lines, docx goes through pandoc to markdown on disk first """
+    if kind == 'docx':
+        from pypandoc import convert_file
+        md_path = path + '.md'
+        convert_file(path, 'gfm', format='docx', outputfile=md_path, extra_args=['--wrap=none'])
+        path = md_path
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return [line.rstrip('\r\n') for line in f]
+
+def windows(count:int, size:int=INGEST_WINDOW_LINES, overlap:int=INGEST_OVERLAP_LINES) -> list[tuple]:
+    """
+    Splits lines 1..count into overlapping windows, returns `(start, end, own_start, own_end)` (inclusive)
+    where `own_*` is the part a window is responsible for: the overlap is split down the middle.
+    """
+    if count <= 0:
+        return []
+    overlap = max(0, min(overlap, size // 2))
+    step = size - overlap
+    spans = []
+    start = 1
+    while True:
+        end = min(count, start + size - 1)
+        spans.append((start, end))
+        if end >= count:
+            break
+        start += step
+    out = []
+    for i, (start, end) in enumerate(spans):
+        own_start = 1 if i == 0 else start + overlap // 2
+        own_end = count if i == len(spans) - 1 else spans[i + 1][0] + overlap // 2 - 1
+        out.append((start, end, own_start, own_end))
+    return out
+
+def parse_outline(text:str) -> list[tuple]:
+    """ `(depth, title, line)` for every entry of an outline, depth from indentation relative to the first entry """
+    entries, indents = [], []
+    for raw in (text or '').splitlines():
+        m = PATTERN_OUTLINE.match(raw.replace('\t', '    '))
+        if not m:
+            continue
+        indent = len(m.group(1))
+        while indents and indent < indents[-1]:
+            indents.pop()
+        if not indents or indent > indents[-1]:
+            indents.append(indent)
+        entries.append((len(indents) - 1, m.group(2).strip('*_ '), int(m.group(3))))
+    return entries
+
+def merge_outlines(outlines:list[tuple], count:int) -> list[tuple]:
+    """
+    One sorted entry list for the whole document from `(window, entries)` pairs.
+    The single top level entry the indexer puts around each window is dropped, the document root stands in for it.
+    Entries outside the part a window owns are left to its neighbour, windows without usable entries get one of their own.
+    """
+    merged = []
+    for (start, end, own_start, own_end), entries in outlines:
+        tops = [e for e in entries if e[0] == 0]
+        if len(tops) == 1 and len(entries) > 1:
+            entries = [e for e in entries if e[0] > 0]
+        else:
+            entries = [(depth + 1, title, line) for depth, title, line in entries]
+        kept = [e for e in entries if own_start <= e[2] <= own_end]
+        if not kept:
+            kept = [(1, f"Lines {own_start}-{own_end}", own_start)]
+        elif not merged and kept[0][2] > 1:
+            # text before the first entry would otherwise belong to nobody
+            kept.insert(0, (1, f"Lines 1-{kept[0][2] - 1}", 1))
+        merged.extend(kept)
+    merged.sort(key=lambda e: e[2])
+    # line numbers are sequential, clamp anything the model made up past the end
+    return [(depth, title, min(max(line, 1), count)) for depth, title, line in merged]
+
+def build_tree(name:str, entries:list[tuple], lines:list[str]) -> dict:
+    """ Nests the entries by depth, each node's body is its lines up to where the next entry starts """
+    def node(title:str, body:str='') -> dict:
+        return {
+            'id': str(uuid.uuid4()), 'content': title, 'name': title, 'body': body,
+            'metadata': {}, 'image_url': None, 'media': [], 'type': None, 'config': {}, 'children': [],
+        }
+    root = node(name)
+    stack = [(0, root)]
+    for i, (depth, title, line) in enumerate(entries):
+        end = entries[i + 1][2] - 1 if i + 1 < len(entries) else len(lines)
+        body = "\n".join(lines[line - 1:end]).strip()
+        n = node(title, body)
+        while len(stack) > 1 and stack[-1][0] >= depth:
+            stack.pop()
+        stack[-1][1]['children'].append(n)
+        stack.append((max(depth, stack[-1][0] + 1), n))
+    return root
+
+async def index_window(lines:list[str], start:int, end:int, folders:list[str], model:str) -> list[tuple]:
+    text = "\n".join(f"{i}: {lines[i - 1]}" for i in range(start, end + 1))
+    stack = get_stack(folders)
+    r = await stack.run(['indexer'], inputs={
+        'text': text,
+        'instruction': 'Write the outline of the text above within the outline tags',
+        'outline_text': '<outline>',
+    }, stops=['</outline>'], model=model)
+    metrics.usage(model, r.usage)
+    return parse_outline(r.get().get('outline', ''))
+
+class IngestJob:
+    """ State of one upload as it moves through the pipeline, reported through `progress` and /upload/{job_id} """
+    def __init__(self, name:str, filename:str, progress=None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.filename = filename
+        self.progress = progress # optional `async (job)` called on every step
+        self.status = 'queued'
+        self.done = 0
+        self.total = 0
+        self.failed = 0
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+
+    def data(self) -> dict:
+        return {
+            'job': self.id, 'name': self.name, 'filename': self.filename, 'status': self.status,
+            'done': self.done, 'total': self.total, 'failed': self.failed, 'error': self.error,
+        }
+
+    async def step(self, status:str=None):
+        if status:
+            self.status = status
+        if self.progress is not None:
+            try:
+                await self.progress(self)
+            except Exception as e:
+                print("Ingest progress failed:", e)
+
+jobs:dict[str, IngestJob] = {}
+
+def remember(job:IngestJob):
+    jobs[job.id] = job
+    finished = [j for j in jobs.values() if j.finished]
+    for old in sorted(finished, key=lambda j: j.finished)[:max(0, len(finished) - INGEST_JOBS_KEPT)]:
+        del jobs[old.id]
+
+async def ingest(job:IngestJob, path:str, kind:str, save, model:str=None, concurrency:int=INGEST_CONCURRENCY) -> dict:
+    """
+    Turns the document at `path` into a tree and hands it to `save(name, tree)`.
+    Indexer calls run at most `concurrency` at a time; a window that fails still gets a plain node.
+    The folder holding `path` is removed when done.
+    """
+    try:
+        await job.step('converting')
+        lines = await asyncio.to_thread(read_lines, path, kind)
+        spans = windows(len(lines))
+        if not spans:
+            raise IngestError("The document is empty")
+        job.total = len(spans)
+        await job.step('indexing')
+        folders, model = resolve_agent(None, model)
+        limit = asyncio.Semaphore(max(1, concurrency))
+        async def run(span):
+            async with limit:
+                try:
+                    async with scheduler.slot():
+                        entries = await index_window(lines, span[0], span[1], folders, model)
+                except Exception as e:
+                    print(f"Indexer failed on lines {span[0]}-{span[1]}:", e)
+                    job.failed += 1
+                    entries = []
+                job.done += 1
+                await job.step()
+                return span, entries
+        outlines = await asyncio.gather(*(run(span) for span in spans))
+        await job.step('saving')
+        tree = build_tree(job.name, merge_outlines(outlines, len(lines)), lines)
+        await save(job.name, tree)
+        job.finished = time.time()
+        await job.step('done')
+        return tree
+    except Exception as e:
+        job.error = str(e)
+        job.finished = time.time()
+        await job.step('failed')
+        raise
+    finally:
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+def workspace() -> str:
+    """ A private temporary folder for one upload """
+    return tempfile.mkdtemp(prefix='ingest-')
@@ -0,0 +1,268 @@
+# metrics.py
+# In-process instrumentation: counters, gauges and histograms rendered in the Prometheus text format for /metrics,
+# stage spans that also land on the current request's timing record, and an optional JSON lines timing log.
+
+import os
+import sys
+import json
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+TIMING_LOG = os.getenv('TIMING_LOG') # JSON lines file of per request timings, `-` for stdout, off when not set
+TOKEN_RATE_SMOOTHING = 0.2 # weight of the latest run in the tokens/sec moving average
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names:tuple, values:tuple, extra:str='') -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _number(value:float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name:str, help:str, labels:tuple=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.values:dict[tuple, float] = {}
+        self.lock = threading.Lock() # store spans are observed from worker threads too
+
+    def set(self, value:float, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, value:float=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name:str, help:str, labels:tuple=(), buckets:tuple=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value:float, *labels):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * len(self.buckets), 0.0, 0] # bucket counts, sum, count
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted((labels, (list(e[0]), e[1], e[2])) for labels, e in self.values.items())
+        for labels, (counts, total, count) in items:
+            running = 0
+            for bound, n in zip(self.buckets, counts):
+                running += n
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {running}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+class Registry:
+    """ Every metric of the process, `collectors` are called right before rendering to refresh gauges """
+    def __init__(self):
+        self.metrics:list[Metric] = []
+        self.collectors:list = []
+
+    def add(self, metric:Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        self.collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        for fn in self.collectors:
+            try:
+                fn()
+            except Exception as e:
+                print("Metrics collector failed:", e)
+        return "\n".join(line for m in self.metrics for line in m.render()) + "\n"
+
+registry = Registry()
+
+# think pipeline
+THINK_STAGE_SECONDS = registry.add(Histogram('deepr_think_stage_seconds', "Time spent in each stage of a think call", ('stage',)))
+LLM_PROMPT_TOKENS = registry.add(Counter('deepr_llm_prompt_tokens_total', "Prompt tokens reported by the LLM endpoint", ('model',)))
+LLM_COMPLETION_TOKENS = registry.add(Counter('deepr_llm_completion_tokens_total', "Completion tokens generated", ('model',)))
+LLM_SECONDS = registry.add(Counter('deepr_llm_seconds_total', "Time spent waiting on LLM completions", ('model',)))
+LLM_TOKENS_PER_SECOND = registry.add(Gauge('deepr_llm_tokens_per_second', "Moving average of completion tokens per second", ('model',)))
+# storage
+STORE_SECONDS = registry.add(Histogram('deepr_store_seconds', "Time spent saving and loading trees", ('op',)))
+# websockets
+WS_CONNECTIONS = registry.add(Gauge('deepr_ws_connections', "Open websocket connections"))
+WS_USERS = registry.add(Gauge('deepr_ws_users', "Users with at least one open connection"))
+WS_CHANNELS = registry.add(Gauge('deepr_ws_channels', "Channels with members"))
+WS_QUEUE_DEPTH = registry.add(Gauge('deepr_ws_broadcast_queue_depth', "Broadcasts waiting to be fanned out"))
+WS_OUTBOX_DEPTH = registry.add(Gauge('deepr_ws_outbox_depth', "Frames waiting in connection outboxes", ('stat',)))
+WS_DROPPED = registry.add(Counter('deepr_ws_dropped_total', "Frames dropped or merged by outbox overflow policies"))
+WS_BROKER_DROPPED = registry.add(Counter('deepr_ws_broker_dropped_total', "Broadcast frames dropped because a worker or the broker stopped reading"))
+WS_SEND_SECONDS = registry.add(Histogram('deepr_ws_send_seconds', "Time from a frame being built to it being written to a socket"))
+# caches and routing
+THINK_CACHE_REQUESTS = registry.add(Counter('deepr_think_cache_requests_total', "Think cache lookups", ('result',)))
+ROUTER_DECISIONS = registry.add(Counter('deepr_router_decisions_total', "agent=\"auto\" decisions by where they came from", ('source',)))
+# admission control
+SCHED_RUNNING = registry.add(Gauge('deepr_sched_running', "Scheduler slots in use, one per concurrent completion", ('endpoint',)))
+SCHED_QUEUED = registry.add(Gauge('deepr_sched_queued', "Requests waiting for a slot", ('endpoint', 'priority')))
+SCHED_WAIT_SECONDS = registry.add(Histogram('deepr_sched_wait_seconds', "Time requests waited for a slot", ('priority',)))
+SCHED_SHED = registry.add(Counter('deepr_sched_shed_total', "Requests turned away with a 429", ('priority', 'reason')))
+# http
+HTTP_SECONDS = registry.add(Histogram('deepr_http_request_seconds', "HTTP request duration, until the last byte of the body", ('method', 'route', 'status')))
+
+# The timing record of the request being served, spans and token counts land on it
+_timing:contextvars.ContextVar = contextvars.ContextVar('timing', default=None)
+
+class Timing:
+    """ One request's spans (seconds per stage, summed when a stage repeats) and token counts """
+    __slots__ = ('request', 'started', 'spans', 'tokens', 'meta')
+
+    def __init__(self, request:str, **meta):
+        self.request = request
+        self.started = time.perf_counter()
+        self.spans:dict[str, float] = {}
+        self.tokens:dict[str, int] = {}
+        self.meta = meta
+
+    def add(self, stage:str, seconds:float):
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+    def data(self, **extra) -> dict:
+        return {
+            'ts': round(time.time(), 3), 'request': self.request,
+            'ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'spans': {k: round(v * 1000, 2) for k, v in self.spans.items()},
+            'tokens': self.tokens, **self.meta, **extra,
+        }
+
+@contextmanager
+def span(histogram:Histogram, label:str):
+    """ Times the block into `histogram` under `label`, and onto the current timing record """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram.observe(elapsed, label)
+        timing = _timing.get()
+        if timing is not None:
+            timing.add(label, elapsed)
+
+def note(stage:str, seconds:float):
+    """ Adds time measured elsewhere to the current timing record """
+    timing = _timing.get()
+    if timing is not None:
+        timing.add(stage, seconds)
+
+def stage(name:str):
+    """ A span of the think pipeline """
+    return span(THINK_STAGE_SECONDS, name)
+
+def usage(model:str, use):
+    """ Records the token usage of one prowl run (a VLLM.Usage) for `model` """
+    model = model or 'unknown'
+    LLM_PROMPT_TOKENS.inc(use.prompt_tokens, model)
+    LLM_COMPLETION_TOKENS.inc(use.completion_tokens, model)
+    LLM_SECONDS.inc(use.elapsed, model)
+    if use.elapsed > 0 and use.completion_tokens:
+        rate = use.completion_tokens / use.elapsed
+        with LLM_TOKENS_PER_SECOND.lock:
+            last = LLM_TOKENS_PER_SECOND.values.get((model,))
+            LLM_TOKENS_PER_SECOND.values[(model,)] = rate if last is None else last + TOKEN_RATE_SMOOTHING * (rate - last)
+    timing = _timing.get()
+    if timing is not None:
+        timing.tokens['prompt'] = timing.tokens.get('prompt', 0) + use.prompt_tokens
+        timing.tokens['completion'] = timing.tokens.get('completion', 0) + use.completion_tokens
+
+class TimingLog:
+    """ Appends one JSON line per finished request to `path` (`-` is stdout) """
+    def __init__(self, path:str):
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+
+    def write(self, record:dict):
+        line = json.dumps(record, separators=(',', ':')) + "\n"
+        with self.lock:
+            if self.file is None:
+                self.file = sys.stdout if self.path == '-' else open(self.path, 'a', encoding='utf-8', buffering=1)
+            self.file.write(line)
+
+timing_log = TimingLog(TIMING_LOG) if TIMING_LOG else None
+
+@contextmanager
+def timed(request:str, **meta):
+    """ Opens a timing record for the work inside the block, and logs it at the end when the timing log is on """
+    timing = Timing(request, **meta)
+    token = _timing.set(timing)
+    try:
+        yield timing
+    finally:
+        _timing.reset(token)
+        if timing_log is not None:
+            try:
+                timing_log.write(timing.data())
+            except Exception as e:
+                print("Timing log failed:", e)
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every HTTP request to the end of its body (streams included) by route template,
+    each request running under its own timing record.
+    """
+    def __init__(self, app, skip:tuple=('/metrics',)):
+        self.app = app
+        self.skip = skip
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] in self.skip:
+            return await self.app(scope, receive, send)
+        status = {'code': 500}
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+            await send(message)
+        with timed(f"{scope['method']} {scope['path']}") as timing:
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                route = getattr(scope.get('route'), 'path', None) or 'unmatched' # templates keep label counts bounded
+                HTTP_SECONDS.observe(time.perf_counter() - timing.started, scope['method'], route, str(status['code']))
+                timing.meta['status'] = status['code']
@@ -0,0 +1,193 @@
+# pubsub.py
+# Broadcast backends for ConnectionManager: how broadcast items reach the connections of every worker
+
+import os
+import json
+import uuid
+import asyncio
+import importlib
+
+from encoding import dumpb
+from metrics import WS_BROKER_DROPPED
+
+WS_BROKER = os.getenv('WS_BROKER', 'memory') # memory, unix, or `module:Class` for a custom backend
+WS_BROKER_PATH = os.getenv('WS_BROKER_PATH', '/tmp/deepr-ws.sock') # unix socket shared by the workers of one host
+WS_BROKER_BUFFER = int(os.getenv('WS_BROKER_BUFFER', 8 * 1024 * 1024)) # bytes queued for a worker (or for the broker) before frames to it are dropped
+LINE_LIMIT = 64 * 1024 * 1024 # largest broadcast frame read from the broker
+
+class BroadcastBackend:
+    """
+    Carries broadcast items to `ConnectionManager.process_queue`.
+
+    An item is a dict with `message`, `channel`, `sender` (the WebSocket it came from, None from other workers)
+    and optionally `senders` for batches. `publish` delivers an item to this worker right away and hands it
+    to `forward`, which is what a backend overrides to reach other workers (a local broker, a network broker, ...).
+    Items read back from other workers go through `receive`. Sockets never leave the worker they belong to.
+    """
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def publish(self, item: dict):
+        await self.queue.put(item)
+        await self.forward(item)
+
+    async def forward(self, item: dict):
+        pass
+
+    def receive(self, channel: str, message: dict):
+        self.queue.put_nowait({"message": message, "sender": None, "channel": channel})
+
+    async def get(self) -> dict:
+        return await self.queue.get()
+
+    def task_done(self):
+        self.queue.task_done()
+
+class MemoryBackend(BroadcastBackend):
+    """ Single process, the channels only span the connections of this worker """
+
+class UnixSocketBackend(BroadcastBackend):
+    """
+    Shares broadcasts between the workers of one host over a unix domain socket.
+
+    One worker is the broker: whoever holds the lock on `<path>.lock` serves `path` and relays every
+    frame to all other connected workers. When it exits the lock is released and the next worker to
+    reconnect takes over, so no separate broker process is needed.
+    Frames are newline delimited JSON: {"origin": worker id, "channel": ..., "message": ...}.
+    Writes never wait on the other end: past `max_buffer` queued bytes frames are dropped and counted in `dropped`.
+    """
+    def __init__(self, path: str = WS_BROKER_PATH, max_buffer: int = WS_BROKER_BUFFER):
+        super().__init__()
+        self.path = path
+        self.max_buffer = max_buffer
+        self.origin = uuid.uuid4().hex
+        self.lock_file = None
+        self.server = None
+        self.peers: set = set()
+        self.writer = None
+        self.connected = asyncio.Event()
+        self.task = None
+        self.dropped = 0
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
+        try:
+            await asyncio.wait_for(self.connected.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            print(f"Broadcast broker at {self.path} not reachable yet, retrying in the background")
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.writer:
+            self.writer.close()
+        if self.server:
+            self.server.close()
+            for peer in list(self.peers):
+                peer.close()
+            await self.server.wait_closed()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        if self.lock_file:
+            self.lock_file.close()
+
+    def try_lead(self) -> bool:
+        """ Takes the broker lock without blocking, True when this worker is (now) the broker """
+        if self.lock_file:
+            return True
+        import fcntl # unix only, and so is this backend
+        f = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self.lock_file = f
+        return True
+
+    async def serve_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.peers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                for peer in self.peers:
+                    if peer is not writer:
+                        self.send(peer, line)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self.peers.discard(writer)
+            writer.close()
+
+    async def run(self):
+        """ Connects to the broker (becoming it when there is none) and reads frames until cancelled """
+        while True:
+            try:
+                if self.server is None and self.try_lead():
+                    try:
+                        os.remove(self.path)
+                    except FileNotFoundError:
+                        pass
+                    self.server = await asyncio.start_unix_server(self.serve_peer, path=self.path, limit=LINE_LIMIT)
+                reader, self.writer = await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
+                self.connected.set()
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    frame = json.loads(line)
+                    if frame.get('origin') != self.origin:
+                        self.receive(frame['channel'], frame['message'])
+            except asyncio.CancelledError:
+                raise
+            except (OSError, ValueError) as e:
+                print("Broadcast broker connection lost:", e)
+            self.connected.clear()
+            if self.writer:
+                self.writer.close()
+                self.writer = None
+            await asyncio.sleep(0.5)
+
+    def send(self, writer: asyncio.StreamWriter, line: bytes):
+        """ Writes a frame unless `max_buffer` bytes already wait for that socket, a stalled reader loses frames instead of growing this worker """
+        if writer.transport.get_write_buffer_size() >= self.max_buffer:
+            self.dropped += 1
+            WS_BROKER_DROPPED.inc()
+            return
+        writer.write(line)
+
+    async def forward(self, item: dict):
+        if self.writer is None:
+            return
+        try:
+            self.send(self.writer, dumpb({"origin": self.origin, "channel": item["channel"], "message": item["message"]}) + b"\n")
+        except (OSError, RuntimeError) as e:
+            print("Broadcast forward failed:", e)
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'unix': UnixSocketBackend,
+}
+
+def make_backend(name: str = WS_BROKER) -> BroadcastBackend:
+    """ A backend by name, or any BroadcastBackend subclass given as `module:Class` (e.g. a network broker) """
+    if name in BACKENDS:
+        return BACKENDS[name]()
+    if ':' in name:
+        module, cls = name.split(':', 1)
+        return getattr(importlib.import_module(module), cls)()
+    raise ValueError(f"Unknown broadcast backend `{name}`")
@@ -0,0 +1,152 @@
+# router.py
+# agent="auto": picks the agent for a request with a local TF-IDF classifier over the agents in defaults.yaml,
+# asking `router.prowl` only when the classifier isn't sure. Decisions are cached per prompt hash.
+
+import os
+import re
+import math
+import hashlib
+from collections import Counter, OrderedDict, deque
+
+import metrics
+from config import config
+from scheduler import scheduler
+from util import get_stack, resolve_agent
+
+AUTO_AGENT = 'auto'
+ROUTER_MIN_SCORE = float(os.getenv('ROUTER_MIN_SCORE', 0.12)) # cosine similarity the best agent needs to skip the LLM
+ROUTER_MIN_MARGIN = float(os.getenv('ROUTER_MIN_MARGIN', 0.04)) # lead the best agent needs over the runner up
+ROUTER_CACHE_SIZE = int(os.getenv('ROUTER_CACHE_SIZE', 4096))
+ROUTER_EXAMPLES = 200 # past LLM routed prompts kept per agent as extra classifier text
+IDENTITY_CHARS = 2000 # of an agent's identity.prowl that goes in its profile
+
+PATTERN_TOKEN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+a an and are as at be but by can do for from has have how i if in into is it its me my of on or our so that
+the their them then there these they this to was we what when where which who why will with would you your
+""".split())
+
+def tokenize(text:str) -> list[str]:
+    return [t for t in PATTERN_TOKEN.findall((text or "").lower()) if len(t) > 1 and t not in STOPWORDS]
+
+class Route:
+    __slots__ = ('agent', 'source', 'score')
+
+    def __init__(self, agent:str, source:str, score:float=None):
+        self.agent = agent
+        self.source = source # classifier, llm or cache
+        self.score = score
+
+    def data(self) -> dict:
+        return {'agent': self.agent, 'source': self.source, 'score': None if self.score is None else round(self.score, 4)}
+
+class AgentRouter:
+    """
+    Each agent is profiled from its defaults.yaml entry, its identity prompt and the prompts the LLM routed to it.
+    Profiles are TF-IDF vectors, rebuilt when the config changes or new examples come in.
+    """
+    def __init__(self, cache_size:int=ROUTER_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.cache:OrderedDict = OrderedDict() # prompt hash -> agent
+        self.examples:dict[str, deque] = {}
+        self.vectors:dict[str, dict] = {}
+        self.idf:dict[str, float] = {}
+        self.built_for = None # config snapshot the vectors were built from
+        self.dirty = True
+        self.stats = Counter()
+
+    @staticmethod
+    def key(prompt:str) -> str:
+        return hashlib.sha256(" ".join((prompt or "").lower().split()).encode('utf-8')).hexdigest()
+
+    def profile(self, name:str, agent) -> str:
+        parts = [name, *(str(agent.get(k) or '') for k in ('description', 'agent_name', 'user_name', 'node_type'))]
+        path = os.path.join('prompts', name, 'identity.prowl')
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                parts.append(f.read(IDENTITY_CHARS))
+        parts.extend(self.examples.get(name, ()))
+        return "\n".join(parts)
+
+    def vector(self, tokens:list[str]) -> dict:
+        counts = Counter(tokens)
+        v = {t: (1 + math.log(c)) * self.idf.get(t, 0.0) for t, c in counts.items()}
+        norm = math.sqrt(sum(x * x for x in v.values())) or 1.0
+        return {t: x / norm for t, x in v.items() if x}
+
+    def build(self):
+        snapshot = config.get()
+        if snapshot is self.built_for and not self.dirty:
+            return
+        if snapshot is not self.built_for:
+            self.cache.clear() # the agents changed, so may the decisions
+        agents = snapshot.data['agents']
+        docs = {name: tokenize(self.profile(name, agent)) for name, agent in agents.items()}
+        df = Counter(t for tokens in docs.values() for t in set(tokens))
+        n = len(docs)
+        self.idf = {t: math.log((1 + n) / (1 + c)) + 1 for t, c in df.items()}
+        self.vectors = {name: self.vector(tokens) for name, tokens in docs.items()}
+        self.built_for, self.dirty = snapshot, False
+
+    def classify(self, prompt:str) -> list[tuple]:
+        """ `(score, agent)` for every agent, best first """
+        self.build()
+        q = self.vector(tokenize(prompt))
+        scores = [(sum(w * vec.get(t, 0.0) for t, w in q.items()), name) for name, vec in self.vectors.items()]
+        return sorted(scores, reverse=True)
+
+    async def ask(self, prompt:str, last_agent:str=None) -> str:
+        """ The LLM fallback with `router.prowl`, in a scheduler slot like any other completion """
+        agents = config.get().data['agents']
+        names = list(agents)
+        listing = "\n".join(
+            f"{i + 1}. {name}: {agents[name].get('description') or agents[name].get('agent_name') or name}"
+            for i, name in enumerate(names)
+        )
+        folders, model = resolve_agent(None, None)
+        async with scheduler.slot():
+            r = await get_stack(folders).run(['router'], inputs={
+                'user_request': prompt, 'agent': last_agent or 'None', 'agents': listing,
+            }, model=model, stops=['\n'])
+        metrics.usage(model, r.usage)
+        pick = re.search(r'\d+', r.get().get('next_agent') or '')
+        n = int(pick.group()) - 1 if pick else -1
+        return names[n] if 0 <= n < len(names) else None
+
+    def remember(self, key:str, agent:str):
+        self.cache[key] = agent
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def route(self, prompt:str, last_agent:str=None) -> Route:
+        """ The agent for `prompt`: from the cache, the classifier when it is confident, else the LLM """
+        self.build()
+        key = self.key(prompt)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.stats['cache'] += 1
+            return Route(self.cache[key], 'cache')
+        scores = self.classify(prompt)
+        best, agent = scores[0]
+        margin = best - (scores[1][0] if len(scores) > 1 else 0.0)
+        if best >= ROUTER_MIN_SCORE and margin >= ROUTER_MIN_MARGIN:
+            self.stats['classifier'] += 1
+            self.remember(key, agent)
+            return Route(agent, 'classifier', best)
+        try:
+            chosen = await self.ask(prompt, last_agent)
+        except Exception as e: # Overloaded included, the classifier's guess beats a 429
+            print("Router LLM call failed:", e)
+            chosen = None
+        if chosen is None:
+            # unusable answer, go with the classifier's best guess but don't learn from it
+            self.stats['fallback'] += 1
+            return Route(agent, 'classifier', best)
+        self.stats['llm'] += 1
+        self.remember(key, chosen)
+        self.examples.setdefault(chosen, deque(maxlen=ROUTER_EXAMPLES)).append(prompt[:1000])
+        self.dirty = True
+        return Route(chosen, 'llm', None)
+
+router = AgentRouter()
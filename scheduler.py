@@ -0,0 +1,265 @@
+# scheduler.py
+# Admission control for LLM work: at most SCHED_CONCURRENCY concurrent completions per endpoint,
+# waiting requests served by priority and then round robin across users, and load shed with a retry hint.
+
+import os
+import math
+import time
+import asyncio
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+import metrics
+
+SCHED_CONCURRENCY = int(os.getenv('SCHED_CONCURRENCY', 8)) # slots per LLM endpoint, one per completion in flight
+SCHED_MAX_WAIT = float(os.getenv('SCHED_MAX_WAIT', 30)) # seconds an interactive request may queue before it is shed
+SCHED_MAX_QUEUED = int(os.getenv('SCHED_MAX_QUEUED', 32)) # requests one user may have waiting, more are turned away
+# priority -> (rank, multiple of SCHED_MAX_WAIT it may queue for, None for no limit)
+PRIORITIES = {
+    'interactive': (0, 1),
+    'batch': (1, 4),
+    'background': (2, None),
+}
+DEFAULT_PRIORITY = 'interactive'
+HOLD_SMOOTHING = 0.2 # weight of the latest run in the average slot hold time behind Retry-After
+INITIAL_HOLD = 5.0 # seconds assumed per run until one has finished
+MAX_RETRY_AFTER = 300
+
+def clamp_priority(priority:str, highest:str) -> str:
+    """ `priority` as asked by a client, but no more urgent than `highest` (which unknown values get too) """
+    if priority not in PRIORITIES or PRIORITIES[priority][0] < PRIORITIES[highest][0]:
+        return highest
+    return priority
+
+class Overloaded(Exception):
+    """ A request that was not admitted, `retry_after` is the suggested wait in seconds """
+    def __init__(self, message:str, retry_after:int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class Ticket:
+    """ Who is asking and how urgently, set for a request with `Scheduler.ticket` and read by `Scheduler.slot` """
+    __slots__ = ('user', 'priority', 'on_position', 'id')
+
+    def __init__(self, user:str=None, priority:str=DEFAULT_PRIORITY, on_position=None, id:str=None):
+        self.user = user or 'anonymous'
+        self.priority = priority if priority in PRIORITIES else DEFAULT_PRIORITY
+        self.on_position = on_position # `(position)` called when the place in line changes, 0 once running
+        self.id = id # the client's name for the request, how it finds itself in `Scheduler.status`
+
+_ticket:contextvars.ContextVar = contextvars.ContextVar('ticket', default=Ticket())
+
+class Waiter:
+    __slots__ = ('ticket', 'weight', 'future', 'enqueued', 'position')
+
+    def __init__(self, ticket:Ticket, weight:int=1):
+        self.ticket = ticket
+        self.weight = weight
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued = time.monotonic()
+        self.position = None
+
+class Lane:
+    """
+    The slots of one endpoint. Waiting requests sit in one queue per user inside each priority level;
+    a free slot goes to the highest level with waiters, and in it to the user whose turn it is.
+    A request can take several slots at once (`weight`), it then waits at the head of the line until enough are free.
+    """
+    def __init__(self, endpoint:str, limit:int):
+        self.endpoint = endpoint
+        self.limit = max(1, limit)
+        self.running = 0 # slots in use
+        self.levels:list[OrderedDict] = [OrderedDict() for _ in PRIORITIES] # user -> deque of waiters, in turn order
+        self.hold = INITIAL_HOLD
+        self.notifying = False # a position update is scheduled
+
+    def waiting(self, rank:int=None) -> int:
+        levels = self.levels if rank is None else self.levels[:rank]
+        return sum(len(q) for level in levels for q in level.values())
+
+    def queued_by(self, user:str) -> int:
+        return sum(len(level.get(user, ())) for level in self.levels)
+
+    def retry_after(self, ahead:int) -> int:
+        """ Rough seconds until `ahead` more requests have been through the slots """
+        return max(1, min(MAX_RETRY_AFTER, math.ceil(self.hold * (ahead + 1) / self.limit)))
+
+    def positions(self):
+        """ `(waiter, position)` for everyone waiting, 1 is next, assuming nobody else arrives """
+        ahead = 0
+        for level in self.levels:
+            if not level:
+                continue
+            # round robin: a user's i-th waiter comes after the first i waiters of every other user, and after
+            # the i-th of the users before it in turn order. `runs[i]` counts the former over all users
+            # (`min(len(q), i)` summed, the user's own i included), `earlier[i]` the latter as users go by.
+            depth = max(len(q) for q in level.values())
+            longer = [0] * (depth + 1) # longer[k]: queues with more than k waiters
+            for queue in level.values():
+                longer[len(queue) - 1] += 1
+            for k in range(depth - 1, 0, -1):
+                longer[k - 1] += longer[k]
+            runs = [0] * depth
+            for i in range(1, depth):
+                runs[i] = runs[i - 1] + longer[i - 1]
+            earlier = [0] * depth
+            for queue in level.values():
+                for i, waiter in enumerate(queue):
+                    yield waiter, ahead + runs[i] + earlier[i] + 1
+                    earlier[i] += 1
+            ahead += sum(len(q) for q in level.values())
+
+    def notify(self):
+        """ Tells the waiters whose place in line changed, once per loop iteration however many events came in it """
+        if not self.notifying:
+            self.notifying = True
+            asyncio.get_running_loop().call_soon(self._notify)
+
+    def _notify(self):
+        self.notifying = False
+        for waiter, position in self.positions():
+            if waiter.position != position:
+                waiter.position = position
+                self.tell(waiter, position)
+
+    @staticmethod
+    def tell(waiter:Waiter, position:int):
+        if waiter.ticket.on_position is not None:
+            try:
+                waiter.ticket.on_position(position)
+            except Exception as e:
+                print("Queue position callback failed:", e)
+
+    def dispatch(self):
+        """ Hands free slots to waiters """
+        started = False
+        while self.running < self.limit:
+            level = next((level for level in self.levels if level), None)
+            if level is None:
+                break
+            user, queue = next(iter(level.items()))
+            if self.running + queue[0].weight > self.limit:
+                break
+            waiter = queue.popleft()
+            if queue:
+                level.move_to_end(user) # their next request waits for everyone else's turn
+            else:
+                del level[user]
+            self.running += waiter.weight
+            waiter.future.set_result(True)
+            started = True
+        if started:
+            self.notify()
+
+    def remove(self, waiter:Waiter):
+        level = self.levels[PRIORITIES[waiter.ticket.priority][0]]
+        queue = level.get(waiter.ticket.user)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del level[waiter.ticket.user]
+            self.notify()
+
+    async def acquire(self, ticket:Ticket, weight:int=1):
+        rank, wait_factor = PRIORITIES[ticket.priority]
+        if self.running + weight <= self.limit and not self.waiting():
+            self.running += weight
+            return
+        if self.queued_by(ticket.user) >= SCHED_MAX_QUEUED:
+            metrics.SCHED_SHED.inc(1, ticket.priority, 'queue_full')
+            raise Overloaded(f"Too many queued requests ({SCHED_MAX_QUEUED}), try again later", self.retry_after(self.waiting()))
+        waiter = Waiter(ticket, weight)
+        self.levels[rank].setdefault(ticket.user, deque()).append(waiter)
+        self.notify()
+        timeout = None if wait_factor is None else SCHED_MAX_WAIT * wait_factor
+        try:
+            done, _ = await asyncio.wait({waiter.future}, timeout=timeout)
+        except asyncio.CancelledError:
+            # the client went away, give back a slot that was granted in the meantime
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release(None, weight)
+            else:
+                self.remove(waiter)
+            raise
+        if not done and not waiter.future.done(): # a slot may have come through after the timeout fired
+            self.remove(waiter)
+            metrics.SCHED_SHED.inc(1, ticket.priority, 'timeout')
+            raise Overloaded(f"Waited {timeout:.0f}s in the queue, try again later", self.retry_after(self.waiting(rank + 1)))
+        self.tell(waiter, 0)
+
+    def release(self, held:float=None, weight:int=1):
+        self.running -= weight
+        if held is not None:
+            self.hold += HOLD_SMOOTHING * (held - self.hold)
+        self.dispatch()
+
+class Scheduler:
+    """ One Lane per completion endpoint """
+    def __init__(self, limit:int=SCHED_CONCURRENCY):
+        self.limit = limit
+        self.lanes:dict[str, Lane] = {}
+
+    def lane(self, endpoint:str=None) -> Lane:
+        endpoint = endpoint or os.getenv('PROWL_VLLM_ENDPOINT') or 'default'
+        lane = self.lanes.get(endpoint)
+        if lane is None:
+            lane = self.lanes[endpoint] = Lane(endpoint, self.limit)
+        return lane
+
+    @contextmanager
+    def ticket(self, user:str=None, priority:str=None, on_position=None, id:str=None):
+        """ Sets who the LLM work inside the block is for, unset values carry over from the enclosing ticket """
+        current = _ticket.get()
+        token = _ticket.set(Ticket(
+            user or current.user, priority or current.priority,
+            on_position if on_position is not None else current.on_position, id or current.id,
+        ))
+        try:
+            yield
+        finally:
+            _ticket.reset(token)
+
+    def check(self, user:str, endpoint:str=None):
+        """ Raises Overloaded right away when `user` could not queue another request, for callers that can't report it later """
+        lane = self.lane(endpoint)
+        if lane.running >= lane.limit and lane.queued_by(user) >= SCHED_MAX_QUEUED:
+            raise Overloaded(f"Too many queued requests ({SCHED_MAX_QUEUED}), try again later", lane.retry_after(lane.waiting()))
+
+    @asynccontextmanager
+    async def slot(self, endpoint:str=None, weight:int=1):
+        """
+        Holds `weight` of the endpoint's slots for the block (one per completion it runs at the same time, capped at the limit),
+        waiting in line under the current ticket
+        """
+        ticket = _ticket.get()
+        lane = self.lane(endpoint)
+        weight = max(1, min(weight, lane.limit))
+        queued = time.perf_counter()
+        await lane.acquire(ticket, weight)
+        waited = time.perf_counter() - queued
+        metrics.SCHED_WAIT_SECONDS.observe(waited, ticket.priority)
+        metrics.note('queue', waited)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            lane.release(time.monotonic() - started, weight)
+
+    def status(self, user:str) -> dict:
+        """ What `user` has waiting and where, for the UI """
+        lanes = []
+        for lane in self.lanes.values():
+            waiting = [
+                {'id': waiter.ticket.id, 'priority': waiter.ticket.priority, 'position': position, 'waited': round(time.monotonic() - waiter.enqueued, 1)}
+                for waiter, position in lane.positions() if waiter.ticket.user == user
+            ]
+            lanes.append({'running': lane.running, 'limit': lane.limit, 'queued': lane.waiting(), 'waiting': waiting})
+        return {
+            'waiting': [w for lane in lanes for w in lane['waiting']],
+            'running': sum(lane['running'] for lane in lanes),
+            'queued': sum(lane['queued'] for lane in lanes),
+            'limit': sum(lane['limit'] for lane in lanes) or self.limit,
+        }
+
+scheduler = Scheduler()
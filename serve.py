@@ -4,11 +4,9 @@
 # Standard libs
 import json
 import asyncio
-from os import listdir
-from os.path import isfile, join
 
 # FastAPI and middleware
-from fastapi import FastAPI, HTTPException, status, Depends, Header
+from fastapi import FastAPI, HTTPException, status, Depends, Header, Response, Request, Query
 from fastapi import WebSocket, WebSocketDisconnect
 from fastapi.websockets import WebSocketState
 from fastapi.middleware.cors import CORSMiddleware
@@ -16,11 +14,11 @@ from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.security import OAuth2PasswordBearer
 
 # Typing
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, PrivateAttr
 from typing import Optional, Dict
 
 # Utility functions
-from util import PATH, think, fetch_models, load_defaults
+from util import PATH, think, think_stream, think_batch, fetch_models, load_defaults, http_pool, THINK_BATCH_MAX_PROMPTS, THINK_BATCH_MAX_CONCURRENCY
 
 # Security and user accounts
 import jwt
@@ -28,24 +26,56 @@ from jwt import PyJWTError
 import traceback
 
 from ws import ConnectionManager, StreamUser
+from cache import ThinkCache, request_key
+from storage import TreeStore, TreeNotFound, InvalidDelta
+from context import ContextBuilder, CONTEXT_TOKENS
+from channels import ChannelStates
+from encoding import FastJSONResponse, dumps, accepts_encoding, etag_matches, not_modified_since
+from email.utils import formatdate
+from config import config
+from router import router, AUTO_AGENT
+from scheduler import scheduler, Overloaded, PRIORITIES, clamp_priority
+import metrics
 
 from contextlib import asynccontextmanager
 manager = ConnectionManager()
+think_cache = ThinkCache()
+store = TreeStore(PATH)
+context_builder = ContextBuilder(store)
+channel_states = ChannelStates(store, manager)
+manager.hooks.append(channel_states.apply)
 
 # Assume 'manager' is already defined and contains process_queue.
 @asynccontextmanager
 async def lifespan(app):
-    # Startup: start the background task for processing the broadcast queue.
-    task = asyncio.create_task(manager.process_queue())
+    # Startup: open the shared HTTP pool and start the background task for processing the broadcast queue.
+    await http_pool.start()
+    await manager.backend.start()
+    await asyncio.to_thread(store.rebuild_catalog) # also search indexes changed legacy trees
+    if hasattr(web_static, 'prepare'):
+        await asyncio.to_thread(web_static.prepare) # compress the web client once, not per request
+    tasks = [
+        asyncio.create_task(manager.process_queue()),
+        asyncio.create_task(manager.process_states()),
+        asyncio.create_task(channel_states.run()),
+    ]
     try:
         yield  # Application is now running.
     finally:
-        # Shutdown: cancel the background task.
-        task.cancel()
-        try:
-            await task
-        except asyncio.CancelledError:
-            pass
+        # Shutdown: cancel the background tasks.
+        for task in tasks:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        for task in list(ingest_tasks) + list(think_tasks):
+            task.cancel()
+        await channel_states.close() # write through what is left before the store closes
+        await manager.backend.close()
+        exporter.close()
+        await http_pool.close()
+        store.close()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -70,6 +100,31 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
+
+@metrics.registry.collector
+def collect_metrics():
+    """ Gauges read from live state when /metrics is scraped """
+    outboxes = [len(o.queue) for o in manager.outboxes.values()]
+    metrics.WS_CONNECTIONS.set(len(manager.outboxes))
+    metrics.WS_USERS.set(len(manager.users))
+    metrics.WS_CHANNELS.set(len(manager.channels))
+    metrics.WS_QUEUE_DEPTH.set(manager.backend.queue.qsize())
+    metrics.WS_OUTBOX_DEPTH.set(sum(outboxes), 'total')
+    metrics.WS_OUTBOX_DEPTH.set(max(outboxes, default=0), 'max')
+    metrics.THINK_CACHE_REQUESTS.set(think_cache.hits, 'hit')
+    metrics.THINK_CACHE_REQUESTS.set(think_cache.misses, 'miss')
+    for source, count in router.stats.items():
+        metrics.ROUTER_DECISIONS.set(count, source)
+    for lane in scheduler.lanes.values():
+        metrics.SCHED_RUNNING.set(lane.running, lane.endpoint)
+        for priority, level in zip(PRIORITIES, lane.levels):
+            metrics.SCHED_QUEUED.set(sum(len(q) for q in level.values()), lane.endpoint, priority)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """ Prometheus text format """
+    return Response(content=metrics.registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 class ThinkRequest(BaseModel):
     prompt: str
@@ -77,29 +132,170 @@ class ThinkRequest(BaseModel):
     agent: Optional[str] = None
     model: Optional[str] = None
     language: Optional[str] = 'English'
+    regenerate: Optional[bool] = False # skip the response cache on purpose
+    # Server side context: without `history`, it is compiled from the stored tree around `node_id`
+    tree: Optional[str] = None
+    node_id: Optional[str] = None
+    create_child: Optional[bool] = True
+    max_levels: Optional[int] = 80
+    recall_depth: Optional[int] = 3
+    priority: Optional[str] = 'interactive' # interactive, batch or background (see scheduler.py), a client can only lower it
+    ticket: Optional[str] = None # the client's id for the request, /queue reports its place in line under it
+    _routing: Optional[dict] = PrivateAttr(default=None) # how `agent="auto"` was resolved
+
+    def cache_key(self, prompt:str) -> str:
+        return request_key(prompt=prompt, agent=self.agent, model=self.model, language=self.language)
+
+async def think_prompt(request: ThinkRequest) -> str:
+    """ The full prompt of a think request, history included. Resolves `agent="auto"` on the way """
+    if request.agent == AUTO_AGENT:
+        route = await router.route(request.prompt)
+        request.agent = route.agent
+        request._routing = route.data()
+    history = request.history
+    if history is None and request.tree and request.node_id:
+        agent_config = (load_defaults().get('agents') or {}).get(request.agent) or {}
+        budget = agent_config.get('context_tokens') or CONTEXT_TOKENS
+        history = await asyncio.to_thread(
+            context_builder.compile, request.tree, request.node_id,
+            request.create_child, request.max_levels, request.recall_depth, budget, agent_config
+        )
+    return (history or "") + request.prompt
+
+def client_key(authorization: Optional[str], client) -> str:
+    """ Who a request is queued as: the JWT user when auth is set up and a valid token came with it, else the client address """
+    if SECRET_KEY and authorization:
+        scheme, _, token = authorization.partition(" ")
+        if scheme.lower() == "bearer" and token:
+            try:
+                return "user:" + verify_jwt_default(token)
+            except HTTPException:
+                pass
+    return "client:" + (client.host if client else "unknown")
+
+def overloaded(e: Overloaded) -> HTTPException:
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
 
 @app.post("/think")
-async def think_endpoint(request: ThinkRequest):
+async def think_endpoint(request: ThinkRequest, http_request: Request, authorization: Optional[str] = Header(None)):
     try:
-        result = await think((request.history or "") + request.prompt, model=request.model, agent=request.agent, language=request.language)
-        return result
+        with scheduler.ticket(user=client_key(authorization, http_request.client), priority=clamp_priority(request.priority, 'interactive'), id=request.ticket):
+            prompt = await think_prompt(request)
+            run = lambda: think(prompt, model=request.model, agent=request.agent, language=request.language)
+            result = await think_cache.get_or_run(request.cache_key(prompt), run, refresh=request.regenerate)
+        if request._routing:
+            result['routing'] = request._routing
+        return FastJSONResponse(result)
+    except TreeNotFound as e:
+        raise HTTPException(status_code=404, detail=f"Tree not found: {e}")
+    except Overloaded as e:
+        raise overloaded(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/queue")
+async def queue_endpoint(http_request: Request, authorization: Optional[str] = Header(None)):
+    """ The caller's think requests waiting for a slot with their place in line (by `ticket`), and how busy the slots are """
+    return scheduler.status(client_key(authorization, http_request.client))
+
+from fastapi.responses import StreamingResponse
+
+@app.post("/think/stream")
+async def think_stream_endpoint(request: ThinkRequest, http_request: Request, authorization: Optional[str] = Header(None)):
+    """
+    Same as /think but as Server-Sent Events: `queued` events while waiting for a slot, `token` events while generating,
+    then one `result` (or `error`, with `status` 429 and `retry_after` when it waited too long)
+    """
+    user = client_key(authorization, http_request.client)
+    priority = clamp_priority(request.priority, 'interactive')
+    try:
+        scheduler.check(user)
+        with scheduler.ticket(user=user, priority=priority, id=request.ticket):
+            prompt = await think_prompt(request)
+    except TreeNotFound as e:
+        raise HTTPException(status_code=404, detail=f"Tree not found: {e}")
+    except Overloaded as e:
+        raise overloaded(e)
+    async def events():
+        key = request.cache_key(prompt)
+        cached = None if request.regenerate else await think_cache.get(key)
+        if cached is not None:
+            yield f"event: result\ndata: {dumps({'event': 'result', 'result': cached})}\n\n"
+            return
+        if request._routing:
+            yield f"event: routing\ndata: {dumps({'event': 'routing', **request._routing})}\n\n"
+        with scheduler.ticket(user=user, priority=priority, id=request.ticket):
+            async for event in think_stream(prompt, model=request.model, agent=request.agent, language=request.language):
+                if event['event'] == 'result':
+                    await think_cache.put(key, event['result'])
+                yield f"event: {event['event']}\ndata: {dumps(event)}\n\n"
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+class ThinkBatchRequest(BaseModel):
+    prompts: list[str] = Field(..., max_length=THINK_BATCH_MAX_PROMPTS)
+    history: Optional[str] = None
+    agent: Optional[str] = None
+    model: Optional[str] = None
+    language: Optional[str] = 'English'
+    concurrency: Optional[int] = Field(None, ge=1, le=THINK_BATCH_MAX_CONCURRENCY)
+    priority: Optional[str] = 'batch' # batch or background, a batch never runs as interactive
+
+@app.post("/think/batch")
+async def think_batch_endpoint(request: ThinkBatchRequest, http_request: Request, authorization: Optional[str] = Header(None)):
+    """ Think on several prompts with a shared history, Server-Sent `result` events arrive as each one finishes """
+    user = client_key(authorization, http_request.client)
+    try:
+        scheduler.check(user)
+    except Overloaded as e:
+        raise overloaded(e)
+    async def events():
+        with scheduler.ticket(user=user, priority=clamp_priority(request.priority, 'batch')):
+            agent = request.agent
+            if agent == AUTO_AGENT:
+                # every prompt gets its own agent
+                agent = [(await router.route(prompt)).agent for prompt in request.prompts]
+            async for index, result, error in think_batch(request.prompts, history=request.history, model=request.model, agent=agent, language=request.language, concurrency=request.concurrency):
+                if error is None:
+                    yield f"event: result\ndata: {dumps({'event': 'result', 'index': index, 'result': result})}\n\n"
+                else:
+                    yield f"event: error\ndata: {dumps({'event': 'error', 'index': index, 'detail': error})}\n\n"
+        yield f"event: done\ndata: {dumps({'event': 'done', 'count': len(request.prompts)})}\n\n"
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
     
 class SaveRequest(BaseModel):
     name: str
     data: dict
 
+class SaveDeltaRequest(BaseModel):
+    name: str
+    upserts: list[dict] = []
+    deletes: list[str] = []
+
 @app.get("/list")
-async def get_data():
-    """ Return the list of different saved trees """
-    o = [f for f in listdir(PATH) if isfile(join(PATH, f))]
-    return o
+async def get_data(prefix: Optional[str] = None, sort: str = 'name', descending: bool = False, offset: int = 0, limit: Optional[int] = None, detail: bool = False):
+    """
+    Return the list of different saved trees from the catalog.
+    Plain `<name>.json` filenames by default, with `detail` a page of metadata and the total count.
+    """
+    try:
+        total, items = await asyncio.to_thread(store.list_catalog, prefix, sort, descending, offset, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if detail:
+        return {'total': total, 'offset': offset, 'items': items}
+    return [f"{item['name']}.json" for item in items]
+
+@app.get("/search")
+async def search_endpoint(q: str, tree: Optional[str] = None, offset: int = Query(0, ge=0), limit: int = Query(20, ge=1, le=200)):
+    """ Full text search over the nodes of all saved trees (or only `tree`), best matches first """
+    try:
+        return await asyncio.to_thread(store.search, q, tree, offset, limit)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/models")
 async def get_data():
-    """ Return the list of possibly selectable models """
-    # should cache models based on the PROWL_VLLM_ENDPOINT
+    """ Return the list of possibly selectable models (cached per PROWL_VLLM_ENDPOINT) """
     try:
         o = await fetch_models()
         return o
@@ -107,131 +303,218 @@ async def get_data():
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/defaults")
-async def get_data():
-    """ Return the list of possibly selectable models """
-    # should cache models based on the PROWL_VLLM_ENDPOINT
+async def get_data(if_none_match: Optional[str] = Header(None)):
+    """ Return the agents and app config from defaults.yaml, pre-encoded and with an ETag """
     try:
-        o = load_defaults()
-        return o
+        snapshot = config.get()
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail=str(e))
+    headers = {'ETag': snapshot.etag, 'Cache-Control': 'no-cache'}
+    if etag_matches(if_none_match, snapshot.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot.json, media_type='application/json', headers=headers)
 
 
 @app.post("/save")
 async def save_endpoint(request: SaveRequest):
+    """ Save a whole tree (compatibility wrapper, prefer /save/delta) """
+    try:
+        reassigned = await asyncio.to_thread(store.save_tree, request.name, request.data)
+        channel_states.saved(request.name, request.data)
+        return {'success': True, 'reassigned': reassigned}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/save/delta")
+async def save_delta_endpoint(request: SaveDeltaRequest):
+    """ Upsert and delete single nodes of a saved tree """
     try:
-        with open(f"{PATH}{request.name}.json", "w+") as f:
-            json.dump(request.data, f)
-        return {'success': True}
+        counts = await asyncio.to_thread(store.apply_delta, request.name, request.upserts, request.deletes)
+        await channel_states.reload(request.name)
+        return {'success': True, **counts}
+    except TreeNotFound as e:
+        raise HTTPException(status_code=404, detail=f"Tree not found: {e}")
+    except InvalidDelta as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/load/{name}")
-async def load_endpoint(name: str):
+async def load_endpoint(name: str, if_none_match: Optional[str] = Header(None), if_modified_since: Optional[str] = Header(None), accept_encoding: Optional[str] = Header(None)):
+    """
+    Load a whole tree as the stored JSON bytes (gzipped when the client takes it), with an ETag and Last-Modified.
+    A client that still has the current version gets a 304 without the tree being read at all.
+    """
     try:
-        with open(f"{PATH}{name}.json", "r") as f:
-            data = json.load(f)
-        # print(data)
-        return data
+        etag, updated, _ = await asyncio.to_thread(store.tree_blob, name)
+        headers = {'ETag': etag, 'Last-Modified': formatdate(updated, usegmt=True), 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        if etag_matches(if_none_match, etag) or (if_none_match is None and not_modified_since(if_modified_since, updated)):
+            return Response(status_code=304, headers=headers)
+        gz = accepts_encoding(accept_encoding, 'gzip')
+        # read again with the content, a save in between means new validators too
+        etag, updated, content = await asyncio.to_thread(store.tree_blob, name, 'gz' if gz else 'body')
+        headers.update({'ETag': etag, 'Last-Modified': formatdate(updated, usegmt=True)})
+        if gz:
+            headers['Content-Encoding'] = 'gzip'
+        return Response(content=content, media_type='application/json', headers=headers)
+    except TreeNotFound as e:
+        raise HTTPException(status_code=404, detail=f"Tree not found: {e}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-from pypandoc import convert_text, download_pandoc
-import tempfile
-from fastapi import BackgroundTasks
+@app.get("/load/{name}/{node_id}")
+async def load_subtree_endpoint(name: str, node_id: str, depth: Optional[int] = None):
+    """ Load the subtree under `node_id`, `depth` levels deep (all of it when not given) """
+    try:
+        return FastJSONResponse(await asyncio.to_thread(store.load_tree, name, node_id, depth))
+    except TreeNotFound as e:
+        raise HTTPException(status_code=404, detail=f"Tree not found: {e}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+import shutil
 from fastapi.responses import FileResponse
+from export import Exporter, tree_markdown, DOCX_MEDIA_TYPE
+
+exporter = Exporter()
 
 class DownloadRequest(BaseModel):
     name:str
     markdown:str
 
 @app.post("/download")
-async def download_docx(request: DownloadRequest, background_tasks: BackgroundTasks):
-    
-    content = request.markdown
-    # Create a temporary file for the DOCX output.
-    with tempfile.NamedTemporaryFile(suffix=".docx", delete=False) as tmp:
-        tmp_path = tmp.name
-
-    # Call your conversion function with the output file path.
-    # This assumes convert_text supports an 'outputfile' parameter.
-    docx_content = convert_text(content, 'docx', format='md', outputfile=tmp_path, extra_args=['--reference-doc=doc/template.docx'])
-
-    # Schedule the temporary file for deletion after response is sent.
-    background_tasks.add_task(os.remove, tmp_path)
-
-    # Return the file as a download.
-    return FileResponse(
-        tmp_path,
-        filename=f"{request.name}.docx",
-        media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-    )
+async def download_docx(request: DownloadRequest):
+    """ Markdown compiled by the client as a docx, converted off the event loop and cached by content """
+    try:
+        path = await exporter.docx(request.markdown)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error converting document: {e}")
+    return FileResponse(path, filename=f"{request.name}.docx", media_type=DOCX_MEDIA_TYPE)
+
+@app.get("/download/{name}")
+async def download_tree_docx(name: str, node_id: Optional[str] = None):
+    """ A stored tree (or the branch under `node_id`) as a docx, built on the server without the client's copy """
+    try:
+        tree = await asyncio.to_thread(store.load_tree, name, node_id)
+        markdown = await asyncio.to_thread(tree_markdown, tree)
+        path = await exporter.docx(markdown)
+    except TreeNotFound as e:
+        raise HTTPException(status_code=404, detail=f"Tree not found: {e}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error converting document: {e}")
+    return FileResponse(path, filename=f"{tree.get('name') or name}.docx", media_type=DOCX_MEDIA_TYPE)
     
 # Upload
 from fastapi import UploadFile, File, Form
 from fastapi.responses import JSONResponse
-#from docx import Document  # if you want to process docx files
-
+import ingest
 
 class UploadMetadata(BaseModel):
     name: str
     description: Optional[str] = None
 
+ingest_tasks = set() # running ingest jobs, referenced so they aren't garbage collected
+
 @app.post("/upload")
 async def upload_endpoint(
+    http_request: Request,
     name: str = Form(...),
     description: str = Form(None),
+    channel: str = Form(None),
+    model: str = Form(None),
     file: UploadFile = File(...),
-    background_tasks: BackgroundTasks = None
+    authorization: Optional[str] = Header(None),
 ):
-    
-    from test_doc import doc2tree
-    tree = None
+    """
+    Ingest a docx, markdown or text document as the tree `name`.
+    The upload is streamed to disk and indexed in the background, the reply only carries the job id.
+    Progress goes to /ws `channel` as `ingest_progress` messages, and is also at /upload/{job_id}.
+    """
     metadata = UploadMetadata(name=name, description=description)
-    file_content = await file.read()
-
-    # Determine action based on MIME type.
-    if file.content_type.startswith("image/"):
-        action = "Processed as image"
-        # e.g., save the image to a folder
-        # filename = f"images/{file.filename}"
-        # with open(filename, "wb") as f:
-        #     f.write(file_content)
-    elif file.content_type in ["text/markdown", "text/plain"]:
-        action = "Processed as text"
-    elif file.content_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-        action = "Processed as DOCX"
-        # For DOCX, you could, for example, load it with python-docx:
+    content_type = file.content_type or ""
+    if content_type.startswith("image/"):
+        return JSONResponse({
+            "success": True,
+            "filename": file.filename,
+            "content_type": content_type,
+            "metadata": metadata.model_dump(),
+            "action": "Processed as image",
+        })
+    kind = ingest.document_kind(content_type, file.filename)
+    if kind is None:
+        raise HTTPException(status_code=400, detail=f"Unsupported file type: {content_type}")
+
+    folder = ingest.workspace()
+    path = os.path.join(folder, 'upload.docx' if kind == 'docx' else 'upload.txt')
+    try:
+        await ingest.save_upload(file, path)
+    except ingest.IngestError as e:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise HTTPException(status_code=500, detail=f"Error receiving upload: {e}")
+
+    async def progress(job: ingest.IngestJob):
+        if channel:
+            await manager.broadcast({"action": "ingest_progress", "channel": channel, **job.data()}, sender=None, channel=channel)
+    async def save(name: str, tree: dict):
+        await asyncio.to_thread(store.save_tree, name, tree)
+        channel_states.saved(name, tree)
+
+    job = ingest.IngestJob(name, file.filename, progress=progress)
+    ingest.remember(job)
+    async def run():
         try:
-            # Optionally, process the DOCX file. Here we create a Document instance.
-            tf = tempfile.NamedTemporaryFile(delete=True, suffix=".docx").name
-            print(tf)
-            tree = await doc2tree('data/test2.docx', name)
-            #doc = Document(tempfile.NamedTemporaryFile(delete=False, suffix=".docx").name)
-            # (Alternatively, save the file_content to a temp file and load it.)
+            await ingest.ingest(job, path, kind, save, model=model)
         except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error processing DOCX: {e}")
-    else:
-        raise HTTPException(status_code=400, detail=f"Unsupported file type: {file.content_type}")
+            print(f"Ingest of {file.filename} failed:", e)
+    # indexer calls queue behind interactive thinking
+    with scheduler.ticket(user=client_key(authorization, http_request.client), priority='background'):
+        task = asyncio.create_task(run())
+    ingest_tasks.add(task)
+    task.add_done_callback(ingest_tasks.discard)
 
-    snippet = file_content.decode("utf-8")[:100] if file.content_type.startswith("text") else None
-
-    # Return a JSON response with details.
     return JSONResponse({
         "success": True,
         "filename": file.filename,
-        "content_type": file.content_type,
+        "content_type": content_type,
         "metadata": metadata.model_dump(),
-        "action": action,
-        # Optionally, return a snippet for text files
-        "snippet": snippet,
-        "tree": tree,
-    })
-    
+        "action": f"Ingesting as {kind}",
+        **job.data(),
+    }, status_code=202)
+
+@app.get("/upload/{job_id}")
+async def upload_status_endpoint(job_id: str):
+    job = ingest.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Upload job not found")
+    return job.data()
+
 
 # Websockets endpoint
-import yaml
+
+think_tasks = set() # running websocket thinks, referenced so they aren't garbage collected
+
+async def think_over_websocket(websocket: WebSocket, message: dict):
+    """ Runs a `think` action from /ws and sends `think_token` messages followed by a `think_result` """
+    request_id = message.get('requestId')
+    with metrics.timed("WS think", requestId=request_id):
+        try:
+            request = ThinkRequest(**message.get('data', {}))
+            user = client_key(websocket.headers.get('authorization'), websocket.client)
+            with scheduler.ticket(user=user, priority=clamp_priority(request.priority, 'interactive'), id=request.ticket or request_id):
+                prompt = await think_prompt(request)
+                if request._routing:
+                    manager.send(websocket, {'action': 'think_routing', 'requestId': request_id, **request._routing})
+                async for event in think_stream(prompt, model=request.model, agent=request.agent, language=request.language):
+                    event['action'] = f"think_{event.pop('event')}"
+                    event['requestId'] = request_id
+                    manager.send(websocket, event)
+        except Exception as e:
+            print("Error in think_over_websocket:", e)
+            manager.send(websocket, {'action': 'think_error', 'requestId': request_id, 'detail': str(e)})
     
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
@@ -250,7 +533,9 @@ async def websocket_endpoint(websocket: WebSocket):
             await websocket.close(code=1008)
             return
 
-        async def join_channel(user_id, channel, config=None):
+        synced = set() # channels this socket was sent a sync for
+
+        async def join_channel(user_id, channel, config=None, seq=None):
             await manager.connect(websocket, user_id, channel)
             # Queue a join message to notify others.
             user:StreamUser = await manager.get_user(user_id)
@@ -262,12 +547,16 @@ async def websocket_endpoint(websocket: WebSocket):
             }
             await manager.broadcast(d, sender=websocket, channel=channel)
             if config is not None:
-                await websocket.send_json({'action': 'init', 'config': config})
-
-        with open('defaults.yaml', 'r') as f:
-            full_config = yaml.safe_load(f)
-        app_config = full_config['app_config']
-        await join_channel(user_id, channel_join, config=app_config)
+                manager.send(websocket, {'action': 'init', 'config': config})
+            # the server's copy of the channel tree: snapshot plus the ops after it, again on a re-join only
+            # when the client says it has fallen behind (a resync would replace what it loaded meanwhile)
+            state = await channel_states.open(channel)
+            if channel not in synced or (isinstance(seq, int) and seq < state.seq):
+                synced.add(channel)
+                manager.send(websocket, state.sync_message())
+
+        app_config = config.get().plain('app_config')
+        await join_channel(user_id, channel_join, config=app_config, seq=join_data.get("seq"))
         while True:
             message:dict = await websocket.receive_json()
             if "action" not in message:
@@ -277,15 +566,24 @@ async def websocket_endpoint(websocket: WebSocket):
             if action == "join_channel":
                 # Allow a user to join another channel.
                 if channel:
-                    await join_channel(user_id, channel)
+                    await join_channel(user_id, channel, seq=message.get("seq"))
                     users = manager.get_users(channel, websocket)
-                    await websocket.send_json({'action': 'list_users', 'users': users})
+                    manager.send(websocket, {'action': 'list_users', 'users': users})
             elif action == "user_update":
                 manager.update_user(message, user_id)
                 await manager.broadcast_to_user_channels(websocket, user_id, message)
             elif action == "list_users":
                 users = manager.get_users(channel, websocket)
-                await websocket.send_json({'action': 'list_users', 'users': users})
+                manager.send(websocket, {'action': 'list_users', 'users': users})
+            elif action == "fullsync":
+                state = await channel_states.open(channel or channel_join)
+                synced.add(channel or channel_join)
+                manager.send(websocket, state.sync_message())
+            elif action == "think":
+                # Streamed think, tokens go back to this connection only
+                task = asyncio.create_task(think_over_websocket(websocket, message))
+                think_tasks.add(task)
+                task.add_done_callback(think_tasks.discard)
             elif action == "user_state":
                 user = await manager.get_user(user_id)
                 user.update_connection_state(channel, websocket, message['fields'])
@@ -294,17 +592,19 @@ async def websocket_endpoint(websocket: WebSocket):
                 # Default broadcast: send to current channel.
                 await manager.broadcast(message, sender=websocket, channel=channel)
     except WebSocketDisconnect:
-        user = manager.users.get(user_id)
-        if user:
-            manager.disconnect(websocket, user_id, user.channel)
-        await manager.broadcast({
-            "action": "user_left",
-            "userId": user_id,
-            "channel": channel_join
-        }, sender=websocket, channel=channel_join)
+        left = manager.disconnect_all(websocket)
+        manager.close_outbox(websocket)
+        for channel in left:
+            await manager.broadcast({
+                "action": "user_left",
+                "userId": user_id,
+                "channel": channel
+            }, sender=websocket, channel=channel)
     except Exception as e:
         print("Error in websocket_endpoint:", e)
         traceback.print_exc()
+        manager.disconnect_all(websocket)
+        manager.close_outbox(websocket)
         await websocket.close(code=1011)
         
 # AUTH FUNCTIONALITY
@@ -432,14 +732,16 @@ async def serve_login():
 ########################################
 #### STATIC MOUNT: KEEP THIS AT THE END!
 ########################################
-from fastapi.staticfiles import StaticFiles
+from static import make_static
+web_static = make_static("web")
 
 # Add GZipMiddleware for responses larger than 1000 bytes (adjust as needed)
+# static files come precompressed and carry Content-Encoding, so it leaves them alone
 app.add_middleware(GZipMiddleware, minimum_size=1000)
 
 # Mount the "web" directory at the root.
 # Endpoints defined above will override these routes.
-app.mount("/", StaticFiles(directory="web", html=True), name="static")
+app.mount("/", web_static, name="static")
 
 
 # For local testing: run `python main.py` or `uvicorn main:app --host 0.0.0.0 --port 8123`
@@ -0,0 +1,171 @@
+# static.py
+# The web client's files served precompressed: gzip and brotli variants are built once at startup and picked
+# by Accept-Encoding, and HTML pages point at their scripts and styles by content hash so those cache for good.
+
+import os
+import re
+import stat
+import gzip
+import hashlib
+import mimetypes
+import threading
+from urllib.parse import parse_qs
+
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import Response
+
+from encoding import accepts_encoding, etag_matches
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_MODE = os.getenv('STATIC_MODE', 'precompressed') # precompressed, or plain to serve files as they are (front end work)
+STATIC_MIN_BYTES = 256 # smaller files go out as they are
+COMPRESSIBLE = ('.js', '.css', '.html', '.svg', '.json', '.md', '.txt', '.map', '.xml')
+VERSION_PARAM = 'v'
+IMMUTABLE = 'public, max-age=31536000, immutable' # for URLs carrying the current content hash
+REVALIDATE = 'no-cache' # everything else is checked against its ETag
+ENCODINGS = ('br', 'gzip') # preferred first
+
+# relative script and stylesheet references of an HTML page
+PATTERN_ASSET = re.compile(r'''(\b(?:src|href)=["'])([^"'?#:]+\.(?:js|css))(["'])''')
+
+class Asset:
+    """ One file in memory: its variants by content coding, their strong ETags and the short hash used in versioned URLs """
+    __slots__ = ('path', 'stamp', 'media_type', 'tag', 'version', 'variants', 'deps')
+
+    def __init__(self, path:str, stamp:tuple, body:bytes, deps:list=None):
+        self.path = path
+        self.stamp = stamp # (mtime_ns, size) of the file it was built from
+        self.media_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        digest = hashlib.sha256(body).hexdigest()
+        self.tag = digest[:32] # ETag of the identity variant, the compressed ones add their coding to it
+        self.version = digest[:12]
+        self.deps = deps or [] # (path, version) of the assets an HTML page was rewritten with
+        self.variants = {'identity': body}
+        if path.endswith(COMPRESSIBLE) and len(body) >= STATIC_MIN_BYTES:
+            gz = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(gz) < len(body):
+                self.variants['gzip'] = gz
+            if brotli is not None:
+                br = brotli.compress(body, quality=11)
+                if len(br) < len(body):
+                    self.variants['br'] = br
+
+    def etag_for(self, coding:str) -> str:
+        """ Each variant has its own strong ETag, they are different bytes (a cache may not mix up their ranges) """
+        return f'"{self.tag}"' if coding == 'identity' else f'"{self.tag}-{coding}"'
+
+    @property
+    def etags(self) -> list[str]:
+        return [self.etag_for(coding) for coding in self.variants]
+
+class PrecompressedStatic(StaticFiles):
+    """
+    StaticFiles that answers from prebuilt in-memory assets instead of reading and GZipMiddleware compressing each time.
+    Path lookup, index.html and 404 handling are StaticFiles' own. A file that changes on disk is rebuilt on its next request,
+    in the worker thread StaticFiles looks the path up in, so reading and compressing it never blocks the event loop.
+    """
+    def __init__(self, directory:str, **kwargs):
+        super().__init__(directory=directory, **kwargs)
+        self.root = os.path.realpath(directory)
+        self.assets:dict[str, Asset] = {}
+        self.lock = threading.RLock() # HTML pages build the assets they link to
+
+    def prepare(self):
+        """ Builds every file up front, scripts and styles before the pages that reference them """
+        files = [os.path.join(d, f) for d, _, names in os.walk(self.root) for f in names]
+        for path in sorted(files, key=lambda p: p.endswith('.html')):
+            try:
+                self.asset(path, os.stat(path))
+            except OSError as e:
+                print(f"Skipping static file {path}:", e)
+        compressed = sum(1 for a in self.assets.values() if len(a.variants) > 1)
+        print(f"Static: {len(self.assets)} files, {compressed} precompressed{'' if brotli else ' (gzip only, brotli is not installed)'}")
+
+    def lookup_path(self, path:str) -> tuple:
+        full_path, stat_result = super().lookup_path(path)
+        if stat_result is not None and stat.S_ISREG(stat_result.st_mode):
+            try:
+                self.asset(full_path, stat_result)
+            except OSError:
+                pass # file_response serves it from disk
+        return full_path, stat_result
+
+    def asset(self, path:str, stat_result:os.stat_result) -> Asset:
+        path = os.path.realpath(path)
+        stamp = (stat_result.st_mtime_ns, stat_result.st_size)
+        asset = self.assets.get(path)
+        if asset is not None and asset.stamp == stamp and not self.stale(asset):
+            return asset
+        with self.lock:
+            asset = self.assets.get(path)
+            if asset is not None and asset.stamp == stamp and not self.stale(asset):
+                return asset # built by another thread meanwhile
+            with open(path, 'rb') as f:
+                body = f.read()
+            deps = None
+            if path.endswith('.html'):
+                body, deps = self.rewrite(path, body)
+            asset = self.assets[path] = Asset(path, stamp, body, deps)
+        return asset
+
+    def stale(self, asset:Asset) -> bool:
+        """ An HTML page is stale once one of the assets it links to has changed """
+        for path, version in asset.deps:
+            try:
+                if self.asset(path, os.stat(path)).version != version:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def rewrite(self, path:str, body:bytes) -> tuple:
+        """ Adds `?v=<content hash>` to the page's local script and stylesheet URLs """
+        folder = os.path.dirname(path)
+        deps = []
+        def versioned(m):
+            ref = m.group(2)
+            target = os.path.realpath(os.path.join(folder, ref))
+            if ref.startswith('/') or not target.startswith(self.root + os.sep) or not os.path.isfile(target):
+                return m.group(0)
+            dep = self.asset(target, os.stat(target))
+            deps.append((target, dep.version))
+            return f"{m.group(1)}{ref}?{VERSION_PARAM}={dep.version}{m.group(3)}"
+        html = PATTERN_ASSET.sub(versioned, body.decode('utf-8'))
+        return html.encode('utf-8'), deps
+
+    def file_response(self, full_path, stat_result, scope, status_code:int=200) -> Response:
+        try:
+            asset = self.asset(full_path, stat_result)
+        except OSError:
+            return super().file_response(full_path, stat_result, scope, status_code)
+        headers = Headers(scope=scope)
+        version = parse_qs(scope.get('query_string', b'').decode('latin-1')).get(VERSION_PARAM, [None])[0]
+        coding = next((c for c in ENCODINGS if c in asset.variants and accepts_encoding(headers.get('accept-encoding'), c)), 'identity')
+        response_headers = {
+            'ETag': asset.etag_for(coding),
+            'Vary': 'Accept-Encoding',
+            'Cache-Control': IMMUTABLE if version == asset.version and not asset.path.endswith('.html') else REVALIDATE,
+        }
+        # any variant's ETag validates, they all stand for the same content
+        if status_code == 200 and etag_matches(headers.get('if-none-match'), *asset.etags):
+            return Response(status_code=304, headers=response_headers)
+        content = asset.variants[coding]
+        if coding != 'identity':
+            response_headers['Content-Encoding'] = coding
+        if scope['method'] == 'HEAD':
+            response_headers['Content-Length'] = str(len(content))
+            content = b''
+        return Response(content=content, status_code=status_code, media_type=asset.media_type, headers=response_headers)
+
+def make_static(directory:str, mode:str=STATIC_MODE) -> StaticFiles:
+    """ The app for `directory`: precompressed unless `mode` is `plain` """
+    if mode == 'plain':
+        return StaticFiles(directory=directory, html=True)
+    if mode != 'precompressed':
+        raise ValueError(f"Unknown STATIC_MODE `{mode}`")
+    return PrecompressedStatic(directory=directory, html=True)
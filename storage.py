@@ -0,0 +1,579 @@
+# storage.py
+# Node level tree storage: every node is a row keyed by its UUID with a link to its parent,
+# so an edit only touches the nodes it changed instead of rewriting the whole tree file.
+
+import os
+import gzip
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+from encoding import dumpb
+from metrics import span, STORE_SECONDS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trees (
+    name TEXT PRIMARY KEY,
+    root_id TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    tree TEXT NOT NULL,
+    id TEXT NOT NULL,
+    parent_id TEXT,
+    position INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL,
+    PRIMARY KEY (tree, id)
+);
+CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (tree, parent_id, position);
+CREATE TABLE IF NOT EXISTS catalog (
+    name TEXT PRIMARY KEY,
+    label TEXT,
+    node_count INTEGER,
+    depth INTEGER,
+    bytes INTEGER,
+    updated REAL,
+    stored INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS search_map (
+    tree TEXT NOT NULL,
+    node_id TEXT NOT NULL,
+    PRIMARY KEY (tree, node_id)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    tree TEXT PRIMARY KEY,
+    etag TEXT NOT NULL,
+    updated REAL NOT NULL,
+    body BLOB NOT NULL,
+    gz BLOB NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(name, body, user_request, tokenize='porter unicode61');
+"""
+
+# bm25 column weights for (name, body, user_request)
+SEARCH_WEIGHTS = (4.0, 1.0, 2.0)
+
+MAX_DEPTH = 4096 # recursive queries stop this deep, so a parent cycle in stored data can't run them forever
+
+BLOB_GZIP_LEVEL = 6
+BLOB_COLUMNS = ('body', 'gz')
+
+CATALOG_FIELDS = ['name', 'label', 'node_count', 'depth', 'bytes', 'updated']
+CATALOG_SORTS = {'name': 'name', 'updated': 'updated', 'node_count': 'node_count', 'depth': 'depth', 'bytes': 'bytes'}
+
+class TreeNotFound(KeyError):
+    pass
+
+class InvalidDelta(ValueError):
+    """ A delta that would break the tree, e.g. by moving a node under its own subtree """
+
+class TreeStore:
+    """
+    SQLite backed tree storage.
+    Trees come in and go out in the same nested `{..., children: [...]}` shape the web client uses.
+    Legacy `data/<name>.json` files are imported the first time they are asked for.
+    """
+    def __init__(self, folder:str, filename:str='trees.sqlite3'):
+        self.folder = folder
+        self.path = os.path.join(folder, filename)
+        os.makedirs(folder, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def json_path(self, name:str) -> str:
+        return os.path.join(self.folder, f"{name}.json")
+
+    # Tree level
+
+    def has_tree(self, name:str) -> bool:
+        with self.lock:
+            row = self.db.execute("SELECT 1 FROM trees WHERE name=?", (name,)).fetchone()
+        return row is not None
+
+    def list_trees(self) -> list[str]:
+        with self.lock:
+            return [r[0] for r in self.db.execute("SELECT name FROM trees ORDER BY name")]
+
+    def find_by_root(self, root_id:str):
+        """ Name of the most recently updated stored tree whose root is `root_id`, None when there is none """
+        with self.lock:
+            row = self.db.execute("SELECT name FROM trees WHERE root_id=? ORDER BY updated DESC LIMIT 1", (root_id,)).fetchone()
+        return row[0] if row else None
+
+    def _ensure(self, name:str):
+        """ Imports a legacy json file for `name` if the tree isn't stored yet """
+        if self.has_tree(name):
+            return
+        path = self.json_path(name)
+        if not os.path.isfile(path):
+            raise TreeNotFound(name)
+        with open(path, 'r') as f:
+            self.save_tree(name, json.load(f), updated=os.path.getmtime(path))
+
+    @staticmethod
+    def unique_ids(tree:dict) -> int:
+        """
+        Gives nodes that repeat an id already used earlier in the tree (pasted branches can) an id of their own,
+        `<id>.<n>`, in place. The same tree always gets the same ids. Returns how many nodes were changed.
+        """
+        nodes, stack = [], [tree]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(node.get('children') or []))
+        taken = {node.get('id') for node in nodes}
+        seen, changed = set(), 0
+        for node in nodes:
+            node_id = node.get('id')
+            if node_id in seen:
+                n = 1
+                while f"{node_id}.{n}" in taken:
+                    n += 1
+                node['id'] = node_id = f"{node_id}.{n}"
+                taken.add(node_id)
+                changed += 1
+            seen.add(node_id)
+        return changed
+
+    @span(STORE_SECONDS, 'save')
+    def save_tree(self, name:str, tree:dict, updated:float=None) -> int:
+        """
+        Replaces the whole tree `name` with the nested `tree`.
+        Duplicate node ids are made unique in `tree` first (see `unique_ids`), the number changed is returned.
+        """
+        reassigned = self.unique_ids(tree)
+        rows = []
+        def walk(node:dict, parent_id, position:int):
+            fields = {k: v for k, v in node.items() if k != 'children'}
+            rows.append((name, node['id'], parent_id, position, json.dumps(fields)))
+            for i, child in enumerate(node.get('children') or []):
+                walk(child, node['id'], i)
+        walk(tree, None, 0)
+        updated = updated or time.time()
+        blob = self._encode(tree)
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM nodes WHERE tree=?", (name,))
+            self.db.executemany("INSERT OR REPLACE INTO nodes (tree, id, parent_id, position, data) VALUES (?, ?, ?, ?, ?)", rows)
+            self.db.execute("INSERT OR REPLACE INTO trees (name, root_id, updated) VALUES (?, ?, ?)", (name, tree['id'], updated))
+            self.db.execute("INSERT OR REPLACE INTO blobs (tree, etag, updated, body, gz) VALUES (?, ?, ?, ?, ?)", (name, blob[0], updated, blob[1], blob[2]))
+            self._catalog_stored(name)
+            self._unindex(name)
+            self._index(name, [(r[1], json.loads(r[4])) for r in rows])
+        return reassigned
+
+    def delete_tree(self, name:str):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM nodes WHERE tree=?", (name,))
+            self.db.execute("DELETE FROM trees WHERE name=?", (name,))
+            self.db.execute("DELETE FROM catalog WHERE name=?", (name,))
+            self.db.execute("DELETE FROM blobs WHERE tree=?", (name,))
+            self._unindex(name)
+
+    # Catalog: per tree metadata so listing never has to open a tree
+
+    def _catalog_stored(self, name:str):
+        """ Recomputes the catalog row of a stored tree, call with the lock held inside a transaction """
+        root_id, updated = self.db.execute("SELECT root_id, updated FROM trees WHERE name=?", (name,)).fetchone()
+        count, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM nodes WHERE tree=?", (name,)).fetchone()
+        depth = self._tree_depth(name, root_id)
+        row = self.db.execute("SELECT data FROM nodes WHERE tree=? AND id=?", (name, root_id)).fetchone()
+        label = json.loads(row[0]).get('name') if row else None
+        self.db.execute(
+            "INSERT OR REPLACE INTO catalog (name, label, node_count, depth, bytes, updated, stored) VALUES (?, ?, ?, ?, ?, ?, 1)",
+            (name, label, count, depth, size, updated)
+        )
+
+    def _tree_depth(self, name:str, root_id:str) -> int:
+        """ Levels below the root of the deepest node, a walk over the whole tree """
+        return self.db.execute("""
+            WITH RECURSIVE sub(id, depth) AS (
+                SELECT id, 0 FROM nodes WHERE tree=? AND id=?
+                UNION ALL
+                SELECT n.id, sub.depth + 1 FROM nodes n JOIN sub ON n.tree=? AND n.parent_id=sub.id WHERE sub.depth < ?
+            )
+            SELECT MAX(depth) FROM sub
+        """, (name, root_id, name, MAX_DEPTH)).fetchone()[0] or 0
+
+    def _refresh_depths(self):
+        """ Recomputes the depths that deltas left unknown, call with the lock held """
+        stale = self.db.execute("SELECT c.name, t.root_id FROM catalog c JOIN trees t ON t.name = c.name WHERE c.depth IS NULL AND c.stored=1").fetchall()
+        if stale:
+            with self.db:
+                self.db.executemany("UPDATE catalog SET depth=? WHERE name=?", [(self._tree_depth(n, r), n) for n, r in stale])
+
+    def rebuild_catalog(self):
+        """
+        Brings the catalog up to date at startup: stored trees are recomputed,
+        legacy json files are only parsed (and search indexed) when they changed since they were last cataloged.
+        """
+        with self.lock, self.db:
+            for name in [r[0] for r in self.db.execute("SELECT name FROM trees")]:
+                try:
+                    self._catalog_stored(name)
+                except Exception as ex: # one broken tree must not keep the server from starting
+                    print(f"Catalog skipped {name}: {ex}")
+            known = {r[0]: r[1] for r in self.db.execute("SELECT name, updated FROM catalog WHERE stored=0")}
+        files = {}
+        for e in os.scandir(self.folder):
+            if e.name.endswith('.json') and e.is_file():
+                files[e.name[:-5]] = e.stat()
+        rows = []
+        for name, st in files.items():
+            if self.has_tree(name) or known.get(name) == st.st_mtime:
+                continue
+            try:
+                with open(self.json_path(name), 'r') as f:
+                    tree = json.load(f)
+                count, depth, nodes = 0, 0, []
+                stack = [(tree, 0)]
+                while stack:
+                    node, d = stack.pop()
+                    count += 1
+                    depth = max(depth, d)
+                    nodes.append((node.get('id'), node))
+                    stack.extend((c, d + 1) for c in node.get('children') or [])
+                with self.lock, self.db:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO catalog (name, label, node_count, depth, bytes, updated, stored) VALUES (?, ?, ?, ?, ?, ?, 0)",
+                        (name, tree.get('name'), count, depth, st.st_size, st.st_mtime)
+                    )
+                    self._unindex(name)
+                    self._index(name, nodes)
+            except Exception as ex:
+                print(f"Catalog skipped {name}: {ex}")
+        with self.lock, self.db:
+            gone = [n for n in known if n not in files]
+            self.db.executemany("DELETE FROM catalog WHERE name=? AND stored=0", [(n,) for n in gone])
+            for n in gone:
+                self._unindex(n)
+
+    def list_catalog(self, prefix:str=None, sort:str='name', descending:bool=False, offset:int=0, limit:int=None) -> tuple[int, list[dict]]:
+        """ Returns `(total, page)` of catalog entries matching `prefix`, sorted by one of CATALOG_SORTS """
+        column = CATALOG_SORTS.get(sort)
+        if column is None:
+            raise ValueError(f"Cannot sort by `{sort}`, use one of {list(CATALOG_SORTS)}")
+        where, args = "", []
+        if prefix:
+            where = "WHERE name >= ? AND name < ?"
+            args = [prefix, prefix + "\U0010ffff"]
+        with self.lock:
+            self._refresh_depths()
+            total = self.db.execute(f"SELECT COUNT(*) FROM catalog {where}", args).fetchone()[0]
+            rows = self.db.execute(
+                f"SELECT {', '.join(CATALOG_FIELDS)} FROM catalog {where} ORDER BY {column} {'DESC' if descending else 'ASC'}, name LIMIT ? OFFSET ?",
+                (*args, -1 if limit is None else limit, offset)
+            ).fetchall()
+        return total, [dict(zip(CATALOG_FIELDS, r)) for r in rows]
+
+    # Node level
+
+    @span(STORE_SECONDS, 'save_delta')
+    def apply_delta(self, name:str, upserts:list[dict]=None, deletes:list[str]=None) -> dict:
+        """
+        Applies node level changes to tree `name` in one transaction.
+
+        Args:
+            upserts: node dicts with an `id`, their fields are merged into the stored node.
+                New nodes need a `parent_id` (a node without one becomes the root of a new tree)
+                and are appended to their parent unless a `position` is given.
+            deletes: ids of nodes to remove along with their whole subtree.
+
+        Returns:
+            dict: counts of `upserted` and `deleted` nodes.
+
+        Raises:
+            InvalidDelta: when a node would move under itself or its own subtree, or its parent is neither
+                in the tree nor in `upserts`, nothing is applied then.
+        """
+        upserts, deletes = upserts or [], deletes or []
+        new_root = None
+        if not self.has_tree(name):
+            try:
+                self._ensure(name)
+            except TreeNotFound:
+                roots = [n for n in upserts if n.get('parent_id') is None]
+                if len(roots) != 1:
+                    raise
+                new_root = roots[0]['id']
+        incoming = {n['id'] for n in upserts}
+        deleted = 0
+        # catalog changes, so the row is adjusted instead of recomputed over the whole tree
+        count, size, depths, moved, label = 0, 0, [], False, None
+        with self.lock, self.db:
+            if new_root is not None:
+                # in the same transaction as its nodes, a refused delta leaves no empty tree behind
+                self.db.execute("INSERT OR IGNORE INTO trees (name, root_id, updated) VALUES (?, ?, ?)", (name, new_root, time.time()))
+            root_id = self.db.execute("SELECT root_id FROM trees WHERE name=?", (name,)).fetchone()[0]
+            for node in upserts:
+                node = dict(node)
+                node_id = node.pop('id')
+                node.pop('children', None)
+                has_parent = 'parent_id' in node
+                parent_id = node.pop('parent_id', None)
+                position = node.pop('position', None)
+                if parent_id is not None and parent_id not in incoming and not self._has_node(name, parent_id):
+                    raise InvalidDelta(f"Parent {parent_id} of node {node_id} is not in the tree")
+                row = self.db.execute("SELECT parent_id, position, data FROM nodes WHERE tree=? AND id=?", (name, node_id)).fetchone()
+                if row is None:
+                    if parent_id == node_id:
+                        raise InvalidDelta(f"Node {node_id} cannot be its own parent")
+                    if parent_id is not None and position is None:
+                        position = self.db.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM nodes WHERE tree=? AND parent_id=?", (name, parent_id)).fetchone()[0]
+                    fields = {'id': node_id, **node}
+                    count += 1
+                    if parent_id is not None:
+                        depths.append(parent_id)
+                else:
+                    fields = json.loads(row[2])
+                    fields.update(node)
+                    if not has_parent:
+                        parent_id = row[0]
+                    elif parent_id != row[0] and self._is_ancestor(name, node_id, parent_id):
+                        raise InvalidDelta(f"Cannot move node {node_id} under {parent_id}, it is inside its subtree")
+                    if position is None:
+                        position = row[1]
+                    moved = moved or parent_id != row[0]
+                    size -= len(row[2])
+                data = json.dumps(fields)
+                size += len(data)
+                if node_id == root_id:
+                    label = fields.get('name')
+                self.db.execute(
+                    "INSERT OR REPLACE INTO nodes (tree, id, parent_id, position, data) VALUES (?, ?, ?, ?, ?)",
+                    (name, node_id, parent_id, position or 0, data)
+                )
+                self._unindex(name, [node_id])
+                self._index(name, [(node_id, fields)])
+            for node_id in deletes:
+                rows = self.db.execute("""
+                    WITH RECURSIVE sub(id, size) AS (
+                        SELECT id, LENGTH(data) FROM nodes WHERE tree=? AND id=?
+                        UNION
+                        SELECT n.id, LENGTH(n.data) FROM nodes n JOIN sub ON n.tree=? AND n.parent_id=sub.id
+                    )
+                    SELECT id, size FROM sub
+                """, (name, node_id, name)).fetchall()
+                gone = [r[0] for r in rows]
+                self.db.executemany("DELETE FROM nodes WHERE tree=? AND id=?", [(name, g) for g in gone])
+                self._unindex(name, gone)
+                deleted += len(gone)
+                count -= len(gone)
+                size -= sum(r[1] for r in rows)
+            updated = time.time()
+            self.db.execute("UPDATE trees SET updated=? WHERE name=?", (updated, name))
+            self.db.execute("DELETE FROM blobs WHERE tree=?", (name,)) # rebuilt on the next whole tree load
+            entry = self.db.execute("SELECT node_count, bytes, depth, label FROM catalog WHERE name=? AND stored=1", (name,)).fetchone()
+            if entry is None:
+                self._catalog_stored(name) # a tree this delta started
+            else:
+                # a new leaf only deepens the tree, moves and deletes leave the depth to be recomputed when it is next listed
+                depth = entry[2]
+                if moved or deleted or depth is None:
+                    depth = None
+                elif depths:
+                    depth = max(depth, max(self._depth(name, p) for p in set(depths)) + 1)
+                self.db.execute(
+                    "UPDATE catalog SET node_count=?, bytes=?, depth=?, label=?, updated=? WHERE name=?",
+                    (entry[0] + count, entry[1] + size, depth, entry[3] if label is None else label, updated, name)
+                )
+        return {'upserted': len(upserts), 'deleted': deleted}
+
+    def _has_node(self, name:str, node_id:str) -> bool:
+        """ Whether tree `name` stores `node_id`, call with the lock held """
+        return self.db.execute("SELECT 1 FROM nodes WHERE tree=? AND id=?", (name, node_id)).fetchone() is not None
+
+    def _depth(self, name:str, node_id:str) -> int:
+        """ Levels between `node_id` and the root, call with the lock held """
+        depth = 0
+        while depth < MAX_DEPTH:
+            row = self.db.execute("SELECT parent_id FROM nodes WHERE tree=? AND id=?", (name, node_id)).fetchone()
+            if row is None or row[0] is None:
+                break
+            node_id = row[0]
+            depth += 1
+        return depth
+
+    def _is_ancestor(self, name:str, node_id:str, other_id:str) -> bool:
+        """ Whether `other_id` is `node_id` or below it, walking up from `other_id`. Call with the lock held. """
+        seen = set()
+        while other_id is not None:
+            if other_id == node_id or other_id in seen: # a cycle already stored counts as one too
+                return True
+            seen.add(other_id)
+            row = self.db.execute("SELECT parent_id FROM nodes WHERE tree=? AND id=?", (name, other_id)).fetchone()
+            other_id = row[0] if row else None
+        return False
+
+    # Blobs: each whole tree kept encoded and gzipped, so loading it is one row read with no JSON work
+
+    @staticmethod
+    def _encode(tree:dict) -> tuple[str, bytes, bytes]:
+        body = dumpb(tree)
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        return etag, body, gzip.compress(body, compresslevel=BLOB_GZIP_LEVEL, mtime=0)
+
+    @span(STORE_SECONDS, 'load_blob')
+    def tree_blob(self, name:str, column:str=None) -> tuple:
+        """
+        `(etag, updated, content)` of the whole tree `name`, `column` picks the content: `body` (JSON), `gz` (gzipped JSON)
+        or None for just the validators. Written by `save_tree`, dropped by `apply_delta` and rebuilt here when missing.
+        """
+        if column is not None and column not in BLOB_COLUMNS:
+            raise ValueError(f"Unknown blob column `{column}`")
+        select = f"SELECT etag, updated{', ' + column if column else ''} FROM blobs WHERE tree=?"
+        with self.lock:
+            row = self.db.execute(select, (name,)).fetchone()
+        if row is not None:
+            return row[0], row[1], row[2] if column else None
+        self._ensure(name)
+        with self.lock:
+            updated = self.db.execute("SELECT updated FROM trees WHERE name=?", (name,)).fetchone()
+        if updated is None:
+            raise TreeNotFound(name)
+        etag, body, gz = self._encode(self.load_tree(name))
+        with self.lock, self.db:
+            # only kept when no write landed while it was being built
+            self.db.execute(
+                "INSERT OR REPLACE INTO blobs (tree, etag, updated, body, gz) SELECT ?, ?, ?, ?, ? WHERE (SELECT updated FROM trees WHERE name=?) = ?",
+                (name, etag, updated[0], body, gz, name, updated[0])
+            )
+        return etag, updated[0], {'body': body, 'gz': gz}.get(column)
+
+    # Search: FTS5 over node names, bodies and user requests, kept in step with every write
+
+    def _index(self, name:str, nodes:list[tuple]):
+        """
+        Adds `(node_id, fields)` to the search index, call with the lock held inside a transaction.
+        A node id that repeats (legacy files can have them) is indexed once, for the first of its nodes in `nodes`.
+        """
+        seen = set()
+        for node_id, fields in nodes:
+            if node_id is None or node_id in seen:
+                continue
+            seen.add(node_id)
+            metadata = fields.get('metadata') if isinstance(fields.get('metadata'), dict) else {}
+            rowid = self.db.execute("INSERT INTO search_map (tree, node_id) VALUES (?, ?)", (name, node_id)).lastrowid
+            self.db.execute(
+                "INSERT INTO search (rowid, name, body, user_request) VALUES (?, ?, ?, ?)",
+                (rowid, fields.get('name') or "", fields.get('body') or "", metadata.get('user_request') or "")
+            )
+
+    def _unindex(self, name:str, node_ids:list[str]=None):
+        """ Drops nodes (the whole tree when `node_ids` is None) from the search index """
+        if node_ids is None:
+            rowids = [r[0] for r in self.db.execute("SELECT rowid FROM search_map WHERE tree=?", (name,))]
+        else:
+            rowids = []
+            for node_id in node_ids:
+                row = self.db.execute("SELECT rowid FROM search_map WHERE tree=? AND node_id=?", (name, node_id)).fetchone()
+                if row:
+                    rowids.append(row[0])
+        self.db.executemany("DELETE FROM search WHERE rowid=?", [(r,) for r in rowids])
+        self.db.executemany("DELETE FROM search_map WHERE rowid=?", [(r,) for r in rowids])
+
+    @staticmethod
+    def match_query(query:str) -> str:
+        """ Plain text to an FTS5 query: every word must match, the last one as a prefix """
+        words = [w.replace('"', '""') for w in query.split()]
+        if not words:
+            return None
+        terms = [f'"{w}"' for w in words]
+        terms[-1] += '*'
+        return " ".join(terms)
+
+    def search(self, query:str, tree:str=None, offset:int=0, limit:int=20) -> list[dict]:
+        """ Ranked (bm25) search over all trees or only `tree`, with a highlighted snippet per hit """
+        match = self.match_query(query)
+        if match is None:
+            return []
+        where, args = "search MATCH ?", [match]
+        if tree is not None:
+            where += " AND m.tree = ?"
+            args.append(tree)
+        with self.lock:
+            rows = self.db.execute(f"""
+                SELECT m.tree, m.node_id, search.name, snippet(search, -1, '**', '**', ' … ', 24), bm25(search, {', '.join(map(str, SEARCH_WEIGHTS))}) AS rank
+                FROM search JOIN search_map m ON m.rowid = search.rowid
+                WHERE {where}
+                ORDER BY rank LIMIT ? OFFSET ?
+            """, (*args, limit, offset)).fetchall()
+        return [{'tree': r[0], 'node_id': r[1], 'name': r[2], 'snippet': r[3], 'score': -r[4]} for r in rows]
+
+    def path_to(self, name:str, node_id:str) -> list[tuple]:
+        """ The `(id, data)` rows from the root down to `node_id`, `data` being the raw json of the node """
+        self._ensure(name)
+        with self.lock:
+            rows = self.db.execute("""
+                WITH RECURSIVE up(id, parent_id, data, depth) AS (
+                    SELECT id, parent_id, data, 0 FROM nodes WHERE tree=? AND id=?
+                    UNION ALL
+                    SELECT n.id, n.parent_id, n.data, up.depth + 1 FROM nodes n JOIN up ON n.tree=? AND n.id=up.parent_id
+                    WHERE up.depth < ?
+                )
+                SELECT id, data FROM up ORDER BY depth DESC
+            """, (name, node_id, name, MAX_DEPTH)).fetchall()
+        if not rows:
+            raise TreeNotFound(f"{name}/{node_id}")
+        return rows
+
+    def get_nodes(self, name:str, ids:list[str]) -> dict[str, str]:
+        """ Raw json of the nodes in `ids` that exist in tree `name` """
+        out = {}
+        with self.lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                q = f"SELECT id, data FROM nodes WHERE tree=? AND id IN ({','.join('?' * len(chunk))})"
+                out.update(self.db.execute(q, (name, *chunk)).fetchall())
+        return out
+
+    @span(STORE_SECONDS, 'load')
+    def load_tree(self, name:str, node_id:str=None, depth:int=None) -> dict:
+        """
+        Returns the nested tree `name`, or the subtree under `node_id`, down to `depth` levels below it.
+        Nodes whose children were cut off by `depth` get `truncated: True` and an empty `children` list.
+        """
+        self._ensure(name)
+        max_depth = MAX_DEPTH if depth is None else min(depth, MAX_DEPTH)
+        with self.lock:
+            if node_id is None:
+                node_id = self.db.execute("SELECT root_id FROM trees WHERE name=?", (name,)).fetchone()[0]
+            rows = self.db.execute("""
+                WITH RECURSIVE sub(id, parent_id, position, data, depth) AS (
+                    SELECT id, parent_id, position, data, 0 FROM nodes WHERE tree=? AND id=?
+                    UNION ALL
+                    SELECT n.id, n.parent_id, n.position, n.data, sub.depth + 1 FROM nodes n
+                    JOIN sub ON n.tree=? AND n.parent_id=sub.id
+                    WHERE sub.depth < ?
+                )
+                SELECT id, parent_id, position, data, depth FROM sub ORDER BY depth, position
+            """, (name, node_id, name, max_depth)).fetchall()
+            if not rows:
+                raise TreeNotFound(f"{name}/{node_id}")
+            edge = [r[0] for r in rows if r[4] == max_depth]
+            truncated = set()
+            for i in range(0, len(edge), 500):
+                chunk = edge[i:i + 500]
+                q = f"SELECT DISTINCT parent_id FROM nodes WHERE tree=? AND parent_id IN ({','.join('?' * len(chunk))})"
+                truncated.update(r[0] for r in self.db.execute(q, (name, *chunk)))
+        nodes = {}
+        root = None
+        for nid, parent_id, _, data, _ in rows:
+            node = json.loads(data)
+            node['children'] = []
+            if nid in truncated:
+                node['truncated'] = True
+            nodes[nid] = node
+            if root is None:
+                root = node
+            elif parent_id in nodes:
+                nodes[parent_id]['children'].append(node)
+        return root
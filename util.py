@@ -1,7 +1,15 @@
 from prowl import ProwlStack, prowl
 import re
+import os
+import copy
+import time
+import asyncio
+
+from config import config
+import metrics
+from scheduler import scheduler, Overloaded
 
-PATH = 'data/'
+PATH = os.getenv('DATA_PATH', 'data/')
 
 models = [
     'qwen/qwen-2.5-7b-instruct',
@@ -75,13 +83,45 @@ def remove_list_blank_lines(markdown_text: str) -> str:
     return "\n".join(new_lines)
 
 
+# Compiled prompt stacks
+
+STACK_CHECK_INTERVAL = 2.0 # seconds between prompt file mtime checks for a cached stack
+_stacks:dict = {} # tuple(folders) -> {'stack', 'signature', 'checked'}
+
+def prompt_signature(folders:list[str]) -> tuple:
+    """ The (path, mtime) of every `.prowl` file in `folders`, changes when prompts are added, removed or edited """
+    sig = []
+    for folder in folders:
+        try:
+            with os.scandir(folder) as it:
+                sig.extend((e.path, e.stat().st_mtime_ns) for e in it if e.name.endswith('.prowl'))
+        except FileNotFoundError:
+            continue
+    return tuple(sorted(sig))
+
+def get_stack(folders:list[str], stop_event=None, token_event=None, variable_event=None) -> ProwlStack:
+    """
+    Returns a ProwlStack for `folders` from the process wide cache, building it on first use
+    or when one of its prompt files has changed since it was built.
+    The returned stack is a shallow copy, so per request callbacks never leak between requests.
+    """
+    key = tuple(folders)
+    now = time.monotonic()
+    entry = _stacks.get(key)
+    if entry is None or now - entry['checked'] > STACK_CHECK_INTERVAL:
+        signature = prompt_signature(folders)
+        if entry is None or entry['signature'] != signature:
+            entry = {'stack': ProwlStack(folder=list(folders), silent=True), 'signature': signature}
+            _stacks[key] = entry
+        entry['checked'] = now
+    stack = copy.copy(entry['stack'])
+    stack.stop_event, stack.token_event, stack.variable_event = stop_event, token_event, variable_event
+    return stack
+
 # Main function
 
-async def think(prompt:str, model=None, agent=None, language='English'):
-    def stop_early(var:prowl.Variable):
-        if var.name == 'stop_now':
-            if "y" in var.value.lower():
-                return False
+def resolve_agent(agent=None, model=None) -> tuple[list[str], str]:
+    """ Returns the prompt folders and the model to use for `agent` """
     folders = ["prompts/"]
     # load agent folder prompts (will auto-override)
     if agent is not None:
@@ -91,42 +131,361 @@ async def think(prompt:str, model=None, agent=None, language='English'):
         if agent_ is not None:
             model = agent_.get('model') or model
     model = model or models[0]
+    return folders, model
+
+async def think(prompt:str, model=None, agent=None, language='English', token_event=None, folders=None):
+    """
+    Run the two stage think pipeline (identity/input/think, then output).
+    Waits for a slot of the scheduler first, as the user and priority of the current ticket.
+    Branch mode agents take a slot for every branch they generate at the same time.
+
+    Args:
+        token_event: optional `async (stage, variable, text)` callback, when given
+            the LLM calls are streamed and every token is passed to it as it arrives.
+        folders: prompt folders already resolved with `resolve_agent`, skips the agent lookup.
+
+    Returns:
+        dict: the prowl variables of both runs, with `thought` and `response` cleaned up.
+
+    Raises:
+        Overloaded: the request was not admitted, see `scheduler.py`.
+    """
+    settings = (load_defaults()['agents'].get(agent) or {}) if agent else {}
+    slots = branch_settings(settings)[1] if settings.get('think_mode') == 'branch' else 1
+    async with scheduler.slot(weight=slots):
+        return await _think(prompt, model=model, agent=agent, language=language, token_event=token_event, folders=folders)
+
+async def _think(prompt:str, model=None, agent=None, language='English', token_event=None, folders=None):
+    """ `think` once it holds a slot """
+    # Early stopping: any variable named `stop_now` that says yes (think.prowl asks after two thoughts) ends the current run
+    state = {'stage': None, 'stop': False, 'variable': None, 'value': ''}
+    def stop_early(name:str, value:str):
+        if name == 'stop_now':
+            if (value or "").strip().lower().startswith("y"):
+                return False
+    async def variable_event(script_name, var:prowl.Variable):
+        if stop_early(var.name, var.value) is False:
+            state['stop'] = True
+    async def stream_event(text, finish_reason=None, variable_name=None):
+        if variable_name != state['variable']:
+            state['variable'], state['value'] = variable_name, ''
+        state['value'] += text
+        await token_event(state['stage'], variable_name, text)
+    async def stop_event():
+        # called by prowl before each variable, so the last streamed variable is complete here
+        if token_event is not None and state['variable'] is not None:
+            if stop_early(state['variable'], state['value']) is False:
+                state['stop'] = True
+        return state['stop']
+
+    with metrics.stage('agent'):
+        if folders is None:
+            folders, model = resolve_agent(agent, model)
+        settings = (load_defaults()['agents'].get(agent) or {}) if agent else {}
+    if settings.get('think_mode') == 'branch':
+        return await think_branched(prompt, model, folders, settings, language=language, token_event=token_event)
+    stream_level = prowl.StreamLevel.TOKEN if token_event is not None else prowl.StreamLevel.VARIABLE
     try:
-        stack = ProwlStack(folder=folders, silent=True) #, stream_level=prowl.StreamLevel.VARIABLE, variable_event=stop_early)
-        r:prowl.Return = await stack.run(['identity', 'input', 'think'], inputs={'user_request': prompt}, model=model, stops=['</think>', '\n\n'])
-        # TODO Introduce early stopping based on streaming
+        with metrics.stage('stack'):
+            stack = get_stack(folders, stop_event=stop_event, token_event=stream_event, variable_event=variable_event)
+        state['stage'] = 'think'
+        with metrics.stage('think'):
+            r:prowl.Return = await stack.run(['identity', 'input', 'think'], inputs={'user_request': prompt}, model=model, stops=['</think>', '\n\n'], stream_level=stream_level)
+        metrics.usage(model, r.usage)
         d = r.get()
-        thoughts = r.var('thought').hist()
+        thoughts = r.var('thought').hist() if r.var('thought') else []
         d['thought'] = "\n".join([v['value'] for v in thoughts])
-        r:prowl.Return = await stack.run(['output'], prefix=r.completion, model=model, inputs={'language': language}, stops=['</reply>'])
+        if state['stop']:
+            d['stopped_early'] = True
+        # an early stop only cuts the thinking short, the reply is always written
+        state.update({'stage': 'output', 'stop': False, 'variable': None, 'value': ''})
+        with metrics.stage('output'):
+            r:prowl.Return = await stack.run(['output'], prefix=r.completion, model=model, inputs={'language': language}, stops=['</reply>'], stream_level=stream_level)
+        metrics.usage(model, r.usage)
         d.update(r.get())
-        d['response'] = remove_list_blank_lines(fix_markdown_bold(d['response']))
+        with metrics.stage('postprocess'):
+            d['response'] = remove_list_blank_lines(fix_markdown_bold(d['response']))
         return d
     except Exception as e:
         print(e)
         raise
 
+# Branch and select: independent thoughts generated concurrently, `after.prowl` picks which ones the reply builds on
+
+BRANCH_COUNT = 5 # thoughts per request when the agent doesn't set `branches`
+BRANCH_VARIABLE = re.compile(r'\{thought\(\s*\d+\s*,\s*([\d.]+)\s*\)\}')
+BRANCH_PLACEHOLDER_REPLY = "(not written yet, it will be based on the most important thought)"
+
+def branch_settings(settings:dict) -> tuple[int, int, int]:
+    """ `(branches, concurrency, select)` of a branch mode agent's settings """
+    count = max(1, int(settings.get('branches') or BRANCH_COUNT))
+    concurrency = max(1, min(count, int(settings.get('branch_concurrency') or count)))
+    select = max(1, min(count, int(settings.get('branch_select') or 1)))
+    return count, concurrency, select
+
+def branch_prompts(stack:ProwlStack) -> tuple[str, list[str], str]:
+    """
+    Splits the agent's `branch.prowl` into what comes before its `{thought(tokens, temperature)}` lines,
+    those lines (each an opener and the temperature of one kind of branch, cycled over the branches) and what follows them.
+    """
+    lines = stack.tasks['branch']['code'].splitlines(keepends=True)
+    found = [i for i, line in enumerate(lines) if BRANCH_VARIABLE.search(line)]
+    if not found:
+        raise ValueError("branch.prowl has no {thought(tokens, temperature)} line")
+    head, tail = ''.join(lines[:found[0]]), ''.join(lines[found[-1] + 1:])
+    return head, [lines[i].rstrip('\n') for i in found], tail
+
+def branch_template(stack:ProwlStack, index:int) -> tuple[str, float]:
+    """ The prompt of branch `index` and its temperature """
+    head, lines, tail = branch_prompts(stack)
+    line = lines[index % len(lines)]
+    return f"{head}{line}\n{tail}", float(BRANCH_VARIABLE.search(line).group(1))
+
+async def rank_thoughts(prompt:str, thoughts:list[str], select:int, folders:list[str], model:str) -> list[int]:
+    """ Indexes of the `select` best thoughts, best first, asking `after.prowl` once per pick """
+    remaining = list(range(len(thoughts)))
+    chosen = []
+    stack = get_stack(folders)
+    while remaining and len(chosen) < select:
+        if len(remaining) == 1:
+            chosen.append(remaining.pop())
+            break
+        thought_list = "\n".join(f"{n + 1}. {thoughts[i]}" for n, i in enumerate(remaining))
+        r:prowl.Return = await stack.run(['after'], inputs={
+            'user_request': prompt, 'response': BRANCH_PLACEHOLDER_REPLY, 'thought_list': thought_list,
+        }, model=model, stops=['\n'])
+        metrics.usage(model, r.usage)
+        pick = re.search(r'\d+', r.get().get('best_thought') or '')
+        n = int(pick.group()) - 1 if pick else 0
+        chosen.append(remaining.pop(n if 0 <= n < len(remaining) else 0))
+    return chosen
+
+async def think_branched(prompt:str, model:str, folders:list[str], settings:dict, language='English', token_event=None):
+    """
+    Tree of thought version of `think`, for agents with `think_mode: branch`.
+
+    `branches` one paragraph thoughts are generated concurrently (at most `branch_concurrency` at once),
+    each with its own opener and temperature from the agent's `branch.prowl`, after `identity` and `input`.
+    `after.prowl` then picks the `branch_select` most important ones, and `output` only sees those.
+    The result has the same keys as `think`, plus `branches`: every thought with its temperature and whether it was selected.
+    """
+    count, concurrency, select = branch_settings(settings)
+    limit = asyncio.Semaphore(concurrency)
+    stream_level = prowl.StreamLevel.TOKEN if token_event is not None else prowl.StreamLevel.VARIABLE
+    try:
+        with metrics.stage('input'):
+            r:prowl.Return = await get_stack(folders).run(['identity', 'input'], inputs={'user_request': prompt}, model=model, stops=['\n\n'])
+        metrics.usage(model, r.usage)
+        base, variables = r.completion, r.variables
+        d = r.get()
+
+        head, _, tail = branch_prompts(get_stack(folders))
+        async def branch(index:int):
+            template, temperature = branch_template(get_stack(folders), index)
+            async def stream_event(text, finish_reason=None, variable_name=None):
+                await token_event('branch', f"thought.{index}", text)
+            async with limit:
+                b:prowl.Return = await get_stack(folders).fill(
+                    base + "\n" + template, variables=dict(variables), stops=['</think>', '\n\n'], stream_level=stream_level, model=model,
+                    token_event=stream_event if token_event is not None else None,
+                )
+            metrics.usage(model, b.usage)
+            return {'thought': (b.get().get('thought') or '').strip(), 'temperature': temperature, 'selected': False}
+        with metrics.stage('branches'):
+            branches = await asyncio.gather(*(branch(i) for i in range(count)))
+
+        thoughts = [b['thought'] for b in branches]
+        with metrics.stage('rank'):
+            chosen = await rank_thoughts(prompt, thoughts, select, folders, model)
+        for i in chosen:
+            branches[i]['selected'] = True
+        d['thought'] = "\n\n".join(thoughts[i] for i in sorted(chosen))
+        d['branches'] = branches
+
+        async def output_event(text, finish_reason=None, variable_name=None):
+            await token_event('output', variable_name, text)
+        stack = get_stack(folders, token_event=output_event if token_event is not None else None)
+        prefix = base + "\n" + head + d['thought'] + "\n" + tail
+        with metrics.stage('output'):
+            r:prowl.Return = await stack.run(['output'], prefix=prefix, model=model, inputs={'language': language}, stops=['</reply>'], stream_level=stream_level)
+        metrics.usage(model, r.usage)
+        d.update(r.get())
+        with metrics.stage('postprocess'):
+            d['response'] = remove_list_blank_lines(fix_markdown_bold(d['response']))
+        return d
+    except Exception as e:
+        print(e)
+        raise
+
+CANCEL_TIMEOUT = 5.0 # seconds to wait for cancelled think runs to let go of their LLM calls
+
+async def cancel_runs(tasks:list, timeout:float=CANCEL_TIMEOUT):
+    """
+    Cancels think runs and waits for them to end, so they don't keep generating (and holding slots) for nobody.
+    prowl's `fill` catches the first CancelledError with a bare except (the LLM request is closed on the way out)
+    and would retry the completion, so the cancel is repeated until the runs are done.
+    """
+    deadline = time.monotonic() + timeout
+    pending = {t for t in tasks if not t.done()}
+    while pending and time.monotonic() < deadline:
+        for task in pending:
+            task.cancel()
+        _, pending = await asyncio.wait(pending, timeout=0.05)
+    if pending:
+        print(f"{len(pending)} cancelled think runs still going after {timeout}s")
+
+async def think_stream(prompt:str, model=None, agent=None, language='English'):
+    """
+    Streaming version of `think`, an async generator of events.
+
+    Yields dicts with an `event` key:
+        queued: {'position'} while waiting for a slot (1 is next), position 0 once it starts, only when it had to wait
+        token: {'stage', 'variable', 'text'} for every generated token
+        result: {'result'} the same dict `think` returns, once at the end
+        error: {'detail'} if the run failed, with `status` 429 and `retry_after` when it was not admitted
+    """
+    queue = asyncio.Queue()
+    async def token_event(stage, variable, text):
+        await queue.put({'event': 'token', 'stage': stage, 'variable': variable, 'text': text})
+    def on_position(position:int):
+        queue.put_nowait({'event': 'queued', 'position': position})
+    async def run():
+        try:
+            with scheduler.ticket(on_position=on_position):
+                result = await think(prompt, model=model, agent=agent, language=language, token_event=token_event)
+            await queue.put({'event': 'result', 'result': result})
+        except Overloaded as e:
+            await queue.put({'event': 'error', 'detail': str(e), 'status': 429, 'retry_after': e.retry_after})
+        except Exception as e:
+            await queue.put({'event': 'error', 'detail': str(e)})
+    task = asyncio.create_task(run())
+    try:
+        while True:
+            event = await queue.get()
+            yield event
+            if event['event'] not in ('token', 'queued'):
+                break
+    finally:
+        # consumer went away (client disconnect), stop generating
+        await cancel_runs([task])
+
+THINK_BATCH_CONCURRENCY = int(os.getenv('THINK_BATCH_CONCURRENCY', 4))
+THINK_BATCH_MAX_PROMPTS = int(os.getenv('THINK_BATCH_MAX_PROMPTS', 64)) # larger /think/batch requests are refused
+THINK_BATCH_MAX_CONCURRENCY = int(os.getenv('THINK_BATCH_MAX_CONCURRENCY', 16))
+
+async def think_batch(prompts:list[str], history:str=None, model=None, agent=None, language='English', concurrency:int=None):
+    """
+    Runs `think` for many prompts sharing one history, at most `concurrency` at a time.
+    `agent` is one agent for every prompt or a list with the agent of each prompt.
+    An async generator yielding `(index, result, error)` in the order the runs finish.
+    """
+    agents = agent if isinstance(agent, list) else [agent] * len(prompts)
+    resolved = {a: resolve_agent(a, model) for a in set(agents)}
+    history = history or ""
+    limit = asyncio.Semaphore(max(1, min(concurrency or THINK_BATCH_CONCURRENCY, THINK_BATCH_MAX_CONCURRENCY, len(prompts) or 1)))
+    async def run(index:int, prompt:str):
+        async with limit:
+            try:
+                folders, agent_model = resolved[agents[index]]
+                return index, await think(history + prompt, model=agent_model, agent=agents[index], language=language, folders=folders), None
+            except Exception as e:
+                return index, None, str(e)
+    tasks = [asyncio.create_task(run(i, p)) for i, p in enumerate(prompts)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        await cancel_runs(tasks)
+
 # Support functions
-import os
 import aiohttp
+from prowl.lib import vllm as prowl_vllm
+
+class _BorrowedSession:
+    """ `async with` hands out the shared session and leaves it open """
+    def __init__(self, session:aiohttp.ClientSession):
+        self.session = session
+    async def __aenter__(self):
+        return self.session
+    async def __aexit__(self, *exc):
+        return False
+
+class _PooledAiohttp:
+    """ Stands in for `aiohttp` inside prowl's VLLM so each LLM call borrows the pool instead of opening a session """
+    def __init__(self, pool):
+        self.pool = pool
+    def __getattr__(self, name):
+        return getattr(aiohttp, name)
+    def ClientSession(self, *args, **kwargs):
+        return _BorrowedSession(self.pool.session)
+
+class HTTPPool:
+    """
+    One connection pooled aiohttp session for the whole app, for model listing and LLM calls.
+    `start()` and `close()` belong in the app lifespan, outside of it callers fall back to a session per call.
+    """
+    def __init__(self, limit:int=100, limit_per_host:int=32):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.session:aiohttp.ClientSession = None
+
+    async def start(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector)
+            prowl_vllm.aiohttp = _PooledAiohttp(self)
+
+    async def close(self):
+        if self.session is not None:
+            prowl_vllm.aiohttp = aiohttp
+            await self.session.close()
+            self.session = None
+
+    def borrow(self):
+        """ Use as `async with pool.borrow() as session` """
+        if self.session is None:
+            return aiohttp.ClientSession()
+        return _BorrowedSession(self.session)
+
+http_pool = HTTPPool(
+    limit=int(os.getenv('HTTP_POOL_LIMIT', 100)),
+    limit_per_host=int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', 32)),
+)
+
+MODELS_TTL = float(os.getenv('MODELS_TTL', 300)) # seconds a /models listing stays fresh
+_models_cache:dict = {} # endpoint -> {'data', 'fetched', 'refresh'}
+
+async def _fetch_models(base_url:str) -> dict:
+    async with http_pool.borrow() as session:
+        async with session.get(f"{base_url}/models") as response:
+            response.raise_for_status()
+            data = await response.json()
+    _models_cache[base_url] = {'data': data, 'fetched': time.monotonic(), 'refresh': None}
+    return data
 
 async def fetch_models() -> dict:
+    """
+    The model listing of PROWL_VLLM_ENDPOINT, cached per endpoint for MODELS_TTL seconds.
+    Once expired the stale listing is still returned while a refresh runs in the background.
+    """
     base_url = os.getenv('PROWL_VLLM_ENDPOINT')
+    entry = _models_cache.get(base_url)
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{base_url}/models") as response:
-                response.raise_for_status()
-                return await response.json()
+        if entry is None:
+            return await _fetch_models(base_url)
+        if time.monotonic() - entry['fetched'] > MODELS_TTL and entry['refresh'] is None:
+            def refreshed(task:asyncio.Task):
+                entry['refresh'] = None
+                if not task.cancelled() and task.exception() is not None:
+                    print(task.exception())
+            entry['refresh'] = asyncio.create_task(_fetch_models(base_url))
+            entry['refresh'].add_done_callback(refreshed)
+        return entry['data']
     except Exception as e:
         print(e)
         raise
 
-import yaml
-def load_defaults() -> dict:
-    with open("defaults.yaml") as stream:
-        try:
-            return yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
-            raise
+def load_defaults():
+    """ The current defaults.yaml snapshot (read only, reloaded by `config` when the file changes) """
+    return config.get().data
 
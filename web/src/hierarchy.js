@@ -214,7 +214,7 @@
         _cloneBranch(node, assignNewIds, newParent = null) {
             // Create a shallow copy; if assignNewIds is true, assign new IDs recursively.
             let cloned = {
-                id: assignNewIds ? "node-" + (this.nodeIdCounter++) : node.id,
+                id: assignNewIds ? window.nav.getId() : node.id, // unique across page loads, a counter restarts at 0
                 content: node.content,
                 name: node.name,
                 body: node.body,
@@ -564,10 +564,15 @@ document.addEventListener("DOMContentLoaded", () => {
   });
 
   sophia.joinChannel = function(channel){
+    if (channel != sophia.seqChannel){
+      sophia.seqChannel = channel;
+      sophia.channelSeq = 0;
+    }
     const data = {
       action: 'join_channel',
       userId: sophia.user.id,
       channel: channel,
+      seq: sophia.channelSeq, // the server only sends a sync again when this is behind
       userData: sophia.user
     };
     console.log("join", data);
@@ -598,7 +603,8 @@ document.addEventListener("DOMContentLoaded", () => {
   sophia.client.on("create", (msg) => {
     console.log("Create received", msg);
     let parentNode = hierarchyEditor.getNode(msg.parentId);
-    if (parentNode){
+    // already here when a resync merged it in before its op is replayed
+    if (parentNode && !hierarchyEditor.getNode(msg.nodeId)){
       let targetNode = hierarchyEditor.createNode(msg.fields.name, parentNode, hierarchyEditor.getNodeType(msg.fields.type));
       targetNode = {...targetNode, ...msg.fields};
       targetNode.id = msg.nodeId;
@@ -720,12 +726,61 @@ document.addEventListener("DOMContentLoaded", () => {
     }, {});
   });
 
+  // Last `seq` of the channel seen here, from a sync or an op of another client
+  sophia.channelSeq = 0;
+  sophia.seqChannel = null;
+  sophia.client.on('message', (msg) => {
+    if (['create', 'update', 'delete'].includes(msg.action) && msg.channel == sophia.seqChannel && msg.seq > sophia.channelSeq){
+      sophia.channelSeq = msg.seq;
+    }
+  });
+
+  sophia.mergeSnapshot = function(snapshot){
+    // Adds the server's nodes this client doesn't have, local nodes and their fields stay as they are
+    let stack = [snapshot];
+    while (stack.length){
+      let node = stack.pop();
+      let local = hierarchyEditor.getNode(node.id);
+      if (!local) continue;
+      (node.children || []).forEach((child) => {
+        if (hierarchyEditor.getNode(child.id)){
+          stack.push(child);
+        }else{
+          sophia.traverseBranch(child, (n) => (n.children || []).forEach((c) => c.parent = n));
+          child.parent = local;
+          local.children.push(child);
+        }
+      });
+    }
+  }
+
+  sophia.client.on('sync', (msg) => {
+    // The server's copy of the channel tree: a snapshot plus the ops logged after it.
+    // Nothing this client hasn't seen yet: keep the tree, it may hold a loaded branch or unsent edits.
+    if (!msg.snapshot || msg.channel != hierarchyEditor.treeData.id || !(msg.head > sophia.channelSeq)) return;
+    let currentId = hierarchyEditor.getCurrentNode().id;
+    if (sophia.dirty){
+      sophia.mergeSnapshot(msg.snapshot);
+    }else{
+      hierarchyEditor.fromJson(msg.snapshot);
+    }
+    msg.ops.forEach((op) => sophia.client._emit(op.action, op));
+    sophia.traverseBranch(hierarchyEditor.treeData, sophia.updateLinks);
+    sophia.seqChannel = msg.channel;
+    sophia.channelSeq = msg.head;
+    if (hierarchyEditor.getNode(currentId)){
+      hierarchyEditor.navigateToNodeById(currentId);
+    }
+    sophia.updateTreeVisualizer(true);
+  });
+
   // TODO Don't forget to send user update on open, (username, etc.) and get user list after that
 
   // fix markdown nested lists (last section ends up first!)
   //  markdown code coloring?
 
   sophia.sendSyncRequest = function(){
+    sophia.channelSeq = 0; // asked for, so the answer is applied
     let data = {
       action: 'fullsync',
       userId: sophia.user.id,
@@ -1138,15 +1193,11 @@ document.addEventListener("DOMContentLoaded", () => {
     }, 0);
   
     try {
-      // Await the fetch call
-      const response = await fetch(`${HOST}/think`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify(data),
+      // Await the fetch call, showing our place in line while the server is busy
+      const result = await sophia.postThink(data, function(position){
+        targetNode.name = position ? `Queued (#${position})...` : "Thinking...";
+        hierarchyEditor.render();
       });
-      const result = await response.json();
   
       // Change the interface accordingly after receiving result
       const responseText = result.response;
@@ -1190,6 +1241,74 @@ document.addEventListener("DOMContentLoaded", () => {
     }
   };
   
+  const THINK_RETRIES = 3; // attempts after a 429 before giving up
+  const QUEUE_POLL_MS = 1000;
+
+  const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+
+  // Thinks waiting on the server, ticket -> {onQueued, position}. One poller covers all of them.
+  const queuedThinks = new Map();
+  let queuePoll = null;
+
+  function pollQueue(){
+    fetch(`${HOST}/queue`)
+      .then(response => response.json())
+      .then(queue => {
+        const positions = new Map(queue.waiting.map(w => [w.id, w.position]));
+        queuedThinks.forEach((entry, ticket) => {
+          const position = positions.get(ticket) || 0; // not waiting: running or not arrived yet
+          if (position !== entry.position) {
+            entry.position = position;
+            entry.onQueued(position);
+          }
+        });
+      })
+      .catch(() => {});
+  }
+
+  function watchQueue(ticket, onQueued){
+    queuedThinks.set(ticket, {onQueued: onQueued, position: 0});
+    if (queuePoll === null) queuePoll = setInterval(pollQueue, QUEUE_POLL_MS);
+  }
+
+  function unwatchQueue(ticket){
+    queuedThinks.delete(ticket);
+    if (queuedThinks.size === 0 && queuePoll !== null) {
+      clearInterval(queuePoll);
+      queuePoll = null;
+    }
+  }
+
+  // POST /think, waiting out 429s for their Retry-After and reporting this request's place in line
+  // (from /queue, 0 once running) to onQueued while it waits for a slot
+  sophia.postThink = async function(data, onQueued){
+    const ticket = window.nav.getId();
+    data = {...data, ticket: ticket};
+    watchQueue(ticket, onQueued);
+    try {
+      for (let attempt = 0; ; attempt++) {
+        const response = await fetch(`${HOST}/think`, {
+          method: 'POST',
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: JSON.stringify(data),
+        });
+        if (response.status === 429 && attempt < THINK_RETRIES) {
+          const wait = parseInt(response.headers.get('Retry-After')) || 1;
+          console.log(`Server busy, retrying in ${wait}s`);
+          await sleep(wait * 1000);
+          continue;
+        }
+        const result = await response.json();
+        if (!response.ok) throw new Error(result.detail || response.statusText);
+        return result;
+      }
+    } finally {
+      unwatchQueue(ticket);
+    }
+  };
+
   sophia.saveData = function(name, globalScope=false){
     if (name.length == 0) return;
     sophia.treeName = name;
@@ -53,6 +53,14 @@ class SophiaWebSocketClient {
         console.error("Error parsing WebSocket message:", event.data);
         return;
       }
+      // Presence updates arrive coalesced, unpack them as if they came one by one.
+      if (data.action === "state_batch") {
+        data.messages.forEach((msg) => {
+          this._emit(msg.action, msg);
+          this._emit("message", msg);
+        });
+        return;
+      }
       // Every message should have an "action" key.
       if (data.action) {
         this._emit(data.action, data);
@@ -1,25 +1,159 @@
 # ws.py
 
+import os
+import time
 import asyncio
+from collections import deque
 from fastapi import WebSocket
 from fastapi.websockets import WebSocketState
 from typing import Dict
+from encoding import Frame
+from pubsub import BroadcastBackend, make_backend
+from metrics import WS_DROPPED, WS_SEND_SECONDS
 
 # ---------------------------
 # WebSocket support for live collaboration
 # ---------------------------
 
+WS_OUTBOX_SIZE = int(os.getenv('WS_OUTBOX_SIZE', 256)) # messages queued per connection before the overflow policy kicks in
+WS_OVERFLOW_POLICY = os.getenv('WS_OVERFLOW_POLICY', 'drop_oldest') # drop_oldest, collapse or disconnect
+STATE_ACTIONS = ('user_state', 'user_update') # presence messages, only the latest one per user matters
+STATE_BATCH = 'state_batch' # coalesced presence messages of one channel, see ConnectionManager.process_states
+WS_STATE_TICK = float(os.getenv('WS_STATE_TICK', 0.1)) # seconds presence messages are coalesced for, 0 sends them right away
+
+def is_state(message: dict) -> bool:
+    return message.get('action') in STATE_ACTIONS or message.get('action') == STATE_BATCH
+
+def merge_states(queued: dict, message: dict):
+    """
+    `message` folded into the presence message `queued`, or None when they don't merge.
+    Two state messages merge when they share action, user and channel. A state batch takes anything from its channel,
+    keeping one message per action and user.
+    """
+    if not is_state(queued) or not is_state(message) or queued.get('channel') != message.get('channel'):
+        return None
+    if STATE_BATCH not in (queued['action'], message['action']):
+        if queued['action'] != message['action'] or queued.get('userId') != message.get('userId'):
+            return None
+        return {**message, 'fields': {**queued.get('fields', {}), **message.get('fields', {})}}
+    entries = {}
+    for part in (queued, message):
+        for m in (part['messages'] if part['action'] == STATE_BATCH else [part]):
+            key = (m.get('action'), m.get('userId'))
+            if key in entries:
+                m = {**m, 'fields': {**entries[key].get('fields', {}), **m.get('fields', {})}}
+            entries[key] = m
+    return {'action': STATE_BATCH, 'channel': message.get('channel'), 'messages': list(entries.values())}
+
+class Outbox:
+    """
+    Bounded outbound queue with its own writer task for one WebSocket,
+    so a slow or stalled client only ever delays its own messages.
+
+    Overflow policies once `maxsize` messages are waiting:
+        drop_oldest: the oldest queued message is dropped.
+        collapse: the message is merged into a queued presence message of the same channel (a state batch,
+            or a state message of the same user), otherwise the oldest presence message is dropped, otherwise the oldest message.
+        disconnect: the client is closed, it will have to rejoin and resync.
+    """
+    def __init__(self, websocket: WebSocket, maxsize: int = WS_OUTBOX_SIZE, policy: str = WS_OVERFLOW_POLICY):
+        if policy not in ('drop_oldest', 'collapse', 'disconnect'):
+            raise ValueError(f"Unknown overflow policy `{policy}`")
+        self.websocket = websocket
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue: deque = deque()
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self.closed = False
+        self.hangup = None # close code the writer task closes the socket with (disconnect policy)
+        self.task = asyncio.create_task(self.run())
+
+    def put(self, message):
+        """ Queue a message (a dict or an already shared Frame) without waiting, applying the overflow policy when full """
+        if self.closed:
+            return
+        if not isinstance(message, Frame):
+            message = Frame(message)
+        if len(self.queue) >= self.maxsize:
+            if self.policy == 'disconnect':
+                self.disconnect(1013)
+                return
+            if self.policy == 'collapse' and self._collapse(message):
+                return
+            self.queue.popleft()
+            self.dropped += 1
+            WS_DROPPED.inc()
+        self.queue.append(message)
+        self.ready.set()
+
+    def _collapse(self, frame: Frame) -> bool:
+        """ Makes room by merging or dropping a presence message, True when `frame` was merged in or queued """
+        message = frame.message
+        if is_state(message):
+            for i, queued in enumerate(self.queue):
+                merged = merge_states(queued.message, message)
+                if merged is not None:
+                    self.queue[i] = Frame(merged)
+                    self.dropped += 1
+                    WS_DROPPED.inc()
+                    return True
+        for i, queued in enumerate(self.queue):
+            if is_state(queued.message):
+                del self.queue[i]
+                self.dropped += 1
+                WS_DROPPED.inc()
+                self.queue.append(frame)
+                self.ready.set()
+                return True
+        return False
+
+    async def run(self):
+        try:
+            while True:
+                while not self.queue and self.hangup is None:
+                    self.ready.clear()
+                    await self.ready.wait()
+                if self.hangup is not None:
+                    await self.websocket.close(code=self.hangup)
+                    break
+                frame = self.queue.popleft()
+                if self.websocket.client_state == WebSocketState.DISCONNECTED:
+                    break
+                await self.websocket.send_text(frame.text)
+                WS_SEND_SECONDS.observe(time.perf_counter() - frame.created)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print("Error sending message:", e)
+        finally:
+            self.closed = True
+
+    def disconnect(self, code:int):
+        """ Drops what is queued and has the writer task close the socket with `code` """
+        self.closed = True
+        self.queue.clear()
+        self.hangup = code
+        self.ready.set()
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+
 class StreamUser:
+    """ A user and their live connections, `connections` maps channel -> {websocket: connection state} """
+    __slots__ = ('id', 'name', 'channel', 'metadata', 'connections')
+    UPDATABLE = ('name', 'metadata') # fields a `user_update` message may change
+
     def __init__(self, user_id: str, channel: str = None, name: str = 'anon', metadata: dict = None):
         self.id = user_id
         self.name = name
         self.channel = channel  # current channel
         self.metadata = metadata or {}
-        # Mapping: channel -> list of WebSocket connections
-        self.connections: Dict[str, list[WebSocket]] = {}
-        # Mapping: channel -> dict mapping each connection to its state data.
-        self.connection_states: Dict[str, dict] = {}
-        
+        self.connections: Dict[str, Dict[WebSocket, dict]] = {}
+
     def data(self, channel:str, websocket:WebSocket):
         return {
             'id': self.id,
@@ -29,42 +163,49 @@ class StreamUser:
         }
 
     def add_connection(self, channel: str, websocket: WebSocket, state: dict = None):
-        if channel not in self.connections:
-            self.connections[channel] = []
-            self.connection_states[channel] = {}
-        if websocket not in self.connections[channel]:
-            self.connections[channel].append(websocket)
-            self.connection_states[channel][websocket] = state or {}
+        sockets = self.connections.setdefault(channel, {})
+        if websocket not in sockets:
+            sockets[websocket] = state or {}
 
     def remove_connection(self, channel: str, websocket: WebSocket):
-        if channel in self.connections and websocket in self.connections[channel]:
-            self.connections[channel].remove(websocket)
-            if websocket in self.connection_states[channel]:
-                del self.connection_states[channel][websocket]
-            if not self.connections[channel]:
+        sockets = self.connections.get(channel)
+        if sockets is not None:
+            sockets.pop(websocket, None)
+            if not sockets:
                 del self.connections[channel]
-                del self.connection_states[channel]
 
     def update_connection_state(self, channel: str, websocket: WebSocket, state_update: dict):
         """Update the state dictionary for a specific connection in a channel."""
-        if channel in self.connection_states and websocket in self.connection_states[channel]:
-            self.connection_states[channel][websocket].update(state_update)
-    
+        state = self.connections.get(channel, {}).get(websocket)
+        if state is not None:
+            state.update(state_update)
+
     def get_connection_state(self, channel: str, websocket: WebSocket) -> dict:
         """Return the current state for the specified connection."""
-        if channel in self.connection_states:
-            return self.connection_states[channel].get(websocket, {})
-        return {}
+        return self.connections.get(channel, {}).get(websocket, {})
+
+    def update(self, fields: dict):
+        for key in self.UPDATABLE:
+            if key in fields:
+                setattr(self, key, fields[key])
 
 class ConnectionManager:
-    def __init__(self):
+    """ Channels, users and connections of this worker, broadcasts reach other workers through `backend` """
+    def __init__(self, backend: BroadcastBackend = None):
         # Channels: mapping channel name -> {"metadata": dict, "connections": {user_id: StreamUser}}
         self.channels: dict[str, dict] = {}
         self.users: dict[str, StreamUser] = {}
-        # Mapping each WebSocket to the channel it’s in.
-        self.websocket_channels: dict[WebSocket, str] = {}
-        # Async queue for broadcast messages.
-        self.broadcast_queue: asyncio.Queue = asyncio.Queue()
+        # Reverse index: each WebSocket -> every channel it joined, and the user it belongs to
+        self.websocket_channels: dict[WebSocket, set[str]] = {}
+        self.websocket_users: dict[WebSocket, str] = {}
+        # Outbound queue and writer per WebSocket
+        self.outboxes: dict[WebSocket, Outbox] = {}
+        # Broadcast items for process_queue, from this worker and (depending on the backend) the others
+        self.backend: BroadcastBackend = backend or make_backend()
+        # Called with every broadcast item before it fans out, local or from another worker (e.g. ChannelStates.apply)
+        self.hooks: list = []
+        # Presence messages waiting for the next tick: channel -> {(action, user_id): {"message", "sender"}}
+        self.pending_states: dict[str, dict] = {}
 
     async def get_user(self, user_id: str, channel: str = None, name: str = 'anon'):
         if user_id not in self.users:
@@ -74,11 +215,11 @@ class ConnectionManager:
         return self.users[user_id]
 
     async def connect(self, websocket: WebSocket, user_id: str, channel: str, state: dict = None):
-        # Disconnect previous assignment if necessary.
-        if websocket in self.websocket_channels:
-            old_channel = self.websocket_channels[websocket]
-            self.disconnect(websocket, user_id, old_channel)
-        self.websocket_channels[websocket] = channel
+        """ Adds `channel` to the channels of `websocket`, a socket may be in several channels at once """
+        self.websocket_channels.setdefault(websocket, set()).add(channel)
+        self.websocket_users[websocket] = user_id
+        if websocket not in self.outboxes:
+            self.outboxes[websocket] = Outbox(websocket)
 
         user = await self.get_user(user_id, channel=channel)
         user.add_connection(channel, websocket, state)
@@ -88,17 +229,48 @@ class ConnectionManager:
         self.channels[channel]["connections"][user_id] = user
 
     def disconnect(self, websocket: WebSocket, user_id: str, channel: str):
-        if channel in self.channels:
-            if user_id in self.channels[channel]['connections']:
-                user = self.users.get(user_id)
-                if user:
-                    user.remove_connection(channel, websocket)
-                    if channel not in user.connections:
-                        self.channels[channel]["connections"].pop(user_id, None)
-            if websocket in self.websocket_channels:
+        """ Removes `websocket` from one channel, the user leaves the channel with their last connection to it """
+        user = self.users.get(user_id)
+        if user:
+            user.remove_connection(channel, websocket)
+            if channel not in user.connections and channel in self.channels:
+                self.channels[channel]["connections"].pop(user_id, None)
+        channels = self.websocket_channels.get(websocket)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
                 del self.websocket_channels[websocket]
-            if channel in self.channels and not self.channels[channel]["connections"]:
-                del self.channels[channel]
+                self.websocket_users.pop(websocket, None)
+        if channel in self.channels and not self.channels[channel]["connections"]:
+            del self.channels[channel]
+
+    def disconnect_all(self, websocket: WebSocket) -> list[str]:
+        """ Removes `websocket` from every channel it joined, returns the channels the user left entirely """
+        user_id = self.websocket_users.get(websocket)
+        left = []
+        for channel in list(self.websocket_channels.get(websocket, ())):
+            self.disconnect(websocket, user_id, channel)
+            user = self.users.get(user_id)
+            if user is None or channel not in user.connections:
+                left.append(channel)
+        self.websocket_channels.pop(websocket, None)
+        self.websocket_users.pop(websocket, None)
+        user = self.users.get(user_id)
+        if user is not None and not user.connections:
+            del self.users[user_id]
+        return left
+
+    def close_outbox(self, websocket: WebSocket):
+        """ Stops the writer of a socket that is gone for good """
+        outbox = self.outboxes.pop(websocket, None)
+        if outbox:
+            outbox.close()
+
+    def send(self, websocket: WebSocket, message: dict):
+        """ Queue a message for one connection, in order with its broadcasts """
+        outbox = self.outboxes.get(websocket)
+        if outbox is not None:
+            outbox.put(message)
 
     def get_users(self, channel: str, websocket:WebSocket):
         if channel in self.channels and self.channels[channel]['connections']:
@@ -109,14 +281,13 @@ class ConnectionManager:
                 'metadata': user.metadata,
                 'state': user.get_connection_state(channel, websocket)  # Aggregated state for the channel
             } for user in self.channels[channel]['connections'].values()]
-            print(o)
             return o
         return []
 
     def update_user(self, message: dict, user_id: str):
         user = self.users.get(user_id)
         if user:
-            user.__dict__.update(message.get('fields', {}))
+            user.update(message.get('fields', {}))
 
     async def broadcast_to_user_channels(self, sender: WebSocket, user_id: str, message: dict):
         user: StreamUser = self.users.get(user_id)
@@ -131,46 +302,93 @@ class ConnectionManager:
 
     async def broadcast(self, message: dict, sender: WebSocket, channel: str = None):
         """
-        Instead of sending immediately, put the message into an async queue.
+        Instead of sending immediately, publish the message to the backend (and so to the other workers).
+        Presence messages (STATE_ACTIONS) are merged per user and channel and go out batched every WS_STATE_TICK.
         """
         channel = channel or message.get('channel', None)
         if channel is None:
             return
-        await self.broadcast_queue.put({
+        if WS_STATE_TICK > 0 and message.get('action') in STATE_ACTIONS:
+            self.coalesce_state(message, sender, channel)
+            return
+        await self.backend.publish({
             "message": message,
             "sender": sender,
             "channel": channel
         })
 
+    def coalesce_state(self, message: dict, sender: WebSocket, channel: str):
+        """ Merge a presence message into the one already waiting from the same user in `channel` """
+        pending = self.pending_states.setdefault(channel, {})
+        key = (message.get('action'), message.get('userId'))
+        if key in pending:
+            merged = dict(message)
+            merged['fields'] = {**pending[key]['message'].get('fields', {}), **message.get('fields', {})}
+            message = merged
+        pending[key] = {"message": message, "sender": sender}
+
+    async def process_states(self):
+        """
+        Background task that flushes coalesced presence messages once per WS_STATE_TICK,
+        one `state_batch` frame per channel instead of a frame per event.
+        """
+        while True:
+            await asyncio.sleep(WS_STATE_TICK)
+            if not self.pending_states:
+                continue
+            pending, self.pending_states = self.pending_states, {}
+            for channel, entries in pending.items():
+                entries = list(entries.values())
+                await self.backend.publish({
+                    "message": {"action": "state_batch", "channel": channel, "messages": [e["message"] for e in entries]},
+                    "sender": None,
+                    "senders": [e["sender"] for e in entries],
+                    "channel": channel,
+                })
+
     async def process_queue(self):
         """
-        Background task to process and send all broadcast messages.
+        Background task to fan out broadcast messages.
+        It only hands messages to each recipient's Outbox, so it never waits on a client.
         """
         while True:
-            item = await self.broadcast_queue.get()
+            item = await self.backend.get()
             message = item["message"]
             sender = item["sender"]
             channel = item["channel"]
+            # batches hold messages from many senders, nobody gets their own messages back
+            senders = item.get("senders")
+            own = set(senders) if senders else ()
 
             if "action" not in message:
                 message["action"] = "unknown"
+            for hook in self.hooks:
+                try:
+                    hook(item)
+                except Exception as e:
+                    print("Error in broadcast hook:", e)
+            # encoded once for every recipient
+            frame = Frame(message)
 
+            to_remove = []
             if channel in self.channels:
                 for uid, user in self.channels[channel]["connections"].items():
-                    if channel in user.connections:
-                        to_remove = []
-                        for connection in user.connections[channel]:
-                            if connection.client_state == WebSocketState.DISCONNECTED:
-                                to_remove.append(connection)
-                                continue
-                            if connection != sender:
-                                try:
-                                    await connection.send_json(message)
-                                except Exception as e:
-                                    print("Error sending message:", e)
-                        for conn in to_remove:
-                            user.remove_connection(channel, conn)
-            self.broadcast_queue.task_done()
+                    for connection in user.connections.get(channel, ()):
+                        outbox = self.outboxes.get(connection)
+                        if connection.client_state == WebSocketState.DISCONNECTED or outbox is None or outbox.closed:
+                            to_remove.append(connection)
+                            continue
+                        if connection in own:
+                            mine = [m for m, s in zip(message["messages"], senders) if s is not connection]
+                            if mine:
+                                outbox.put({**message, "messages": mine})
+                        elif connection is not sender:
+                            outbox.put(frame)
+            # dead sockets leave every channel they were in, not just this one
+            for conn in to_remove:
+                self.disconnect_all(conn)
+                self.close_outbox(conn)
+            self.backend.task_done()
 
     def create_channel(self, channel: str, metadata: dict = None):
         if channel not in self.channels: